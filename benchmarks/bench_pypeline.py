@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Benchmarks of the orchestration overhead of a Pypeline: scheduling no-op
+steps, logging messages with _write_output() and parsing steplists."""
+
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from pypeline import Pypeline, PypeStep, PythonPypeStep, parse_steplist, parse_steplist_str
+
+
+class NoopStep(PypeStep) :
+    """Step that does nothing without leaving the event loop, so running it
+    costs only the pipeline's own bookkeeping"""
+
+    async def execute_async(self) :
+        return None
+
+
+def noop() :
+    return None
+
+
+@contextlib.contextmanager
+def quiet() :
+    """Send everything written to stderr to /dev/null, the pipeline's
+    messages still go through the same file descriptor writes"""
+    sys.stderr.flush()
+    saved = os.dup(2)
+    devnull = os.open(os.devnull,os.O_WRONLY)
+    os.dup2(devnull,2)
+    os.close(devnull)
+    try :
+        yield
+    finally :
+        sys.stderr.flush()
+        os.dup2(saved,2)
+        os.close(saved)
+
+
+def scheduling(n,step_cls='noop',max_workers=1) :
+    """Time adding and running *n* no-op steps, NoopSteps or
+    PythonPypeSteps calling a no-op function in a thread"""
+    with quiet() :
+        pipeline = Pypeline('bench',fingerprints=None,history=None,max_workers=max_workers)
+        st = time.time()
+        if step_cls == 'noop' :
+            steps = [NoopStep('step %d'%i,silent=True) for i in range(n)]
+        else :
+            steps = [PythonPypeStep('step %d'%i,noop,silent=True) for i in range(n)]
+        pipeline.add_steps(steps)
+        added = time.time()
+        pipeline.run()
+        done = time.time()
+    return {'steps':n,
+            'add_seconds':added-st,
+            'run_seconds':done-added,
+            'per_step_us':(done-st)/n*1e6}
+
+
+def write_output(n=100000,log=True) :
+    """Time *n* pipeline.info() messages, written to stderr and a log file"""
+    fd, log_fn = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    with quiet() :
+        pipeline = Pypeline('bench',log=log_fn if log else None,fingerprints=None,
+                            report=False)
+        st = time.time()
+        for i in range(n) :
+            pipeline.info('message %d'%i)
+        elapsed = time.time()-st
+        pipeline.tee_t.close(timeout=10)
+    for f in pipeline.tee_t.wlist[1:] :
+        f.close()
+    os.remove(log_fn)
+    return {'messages':n,
+            'seconds':elapsed,
+            'per_message_us':elapsed/n*1e6}
+
+
+class _Steps :
+    """Stand-in for a pipeline with *n* steps for parse_steplist()"""
+    def __init__(self,n) :
+        self.steps = [None]*n
+    def error(self,st) :
+        sys.stderr.write(st+'\n')
+
+
+def steplist(span,probes=1000) :
+    """Time parsing the steplist '0-<span>' and testing up to *probes*
+    evenly spaced steps for membership in the result"""
+    spec = '0-%d,%d'%(span-1,span+1)
+    st = time.time()
+    parse_steplist_str(spec)
+    parse_str_s = time.time()-st
+
+    pipeline = _Steps(span+2)
+    st = time.time()
+    selected = parse_steplist(spec,pipeline)
+    parse_s = time.time()-st
+
+    indices = range(0,span+2,max(1,(span+2)//probes))
+    st = time.time()
+    for i in indices :
+        i in selected
+    member_s = time.time()-st
+    return {'span':span,
+            'parse_steplist_str_seconds':parse_str_s,
+            'parse_steplist_seconds':parse_s,
+            'membership_us':member_s/len(indices)*1e6}
+
+
+def run(sizes=(10,100,1000,10000,100000),python_max=10000,messages=100000,
+        spans=(1000,100000,1000000)) :
+    """Run all the benchmarks, PythonPypeSteps are only scheduled up to
+    *python_max* steps since each one starts a thread"""
+    return {'scheduling':{'noop':[scheduling(n) for n in sizes],
+                          'python':[scheduling(n,'python') for n in sizes if n <= python_max],
+                          'noop_parallel':[scheduling(n,max_workers=8) for n in sizes]},
+            'write_output':write_output(messages),
+            'parse_steplist':[steplist(n) for n in spans]}
+
+
+if __name__ == '__main__' :
+
+    parser = OptionParser(usage='%prog [options]',description=__doc__)
+    parser.add_option('--sizes',dest='sizes',default='10,100,1000,10000,100000',help='comma separated numbers of steps to schedule [default: %default]')
+    parser.add_option('--python-max',dest='python_max',type='int',default=10000,help='largest number of PythonPypeSteps to schedule [default: %default]')
+    parser.add_option('--messages',dest='messages',type='int',default=100000,help='number of messages to log [default: %default]')
+    parser.add_option('--spans',dest='spans',default='1000,100000,1000000',help='comma separated steplist span lengths [default: %default]')
+    opts, args = parser.parse_args(sys.argv[1:])
+
+    json.dump(run([int(n) for n in opts.sizes.split(',')],opts.python_max,opts.messages,
+                  [int(n) for n in opts.spans.split(',')]),sys.stdout,indent=2)
+    sys.stdout.write('\n')
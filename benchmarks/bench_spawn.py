@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Launch latency benchmark for ProcessPypeStep commands: commands exec'd
+directly from an argv list compared with commands run through /bin/sh, for
+bare subprocess.Popen launches and whole pipeline steps, and steps running
+their commands in a shell pool."""
+
+import json
+import os
+import sys
+import time
+
+from optparse import OptionParser
+from subprocess import Popen
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from pypeline import Pypeline, ProcessPypeStep, popen_command
+
+
+def launches(start,n) :
+    """Time *n* calls of *start*, which starts a process and returns its
+    Popen, each until the process has exited"""
+    times = []
+    for _ in range(n) :
+        st = time.time()
+        start().wait()
+        times.append(time.time()-st)
+    times.sort()
+    return {'launches':n,
+            'mean_ms':sum(times)/n*1e3,
+            'median_ms':times[n//2]*1e3,
+            'p99_ms':times[min(n-1,int(n*0.99))]*1e3}
+
+
+def step(cmd,n,shell_pool=False) :
+    """Time a pipeline step running *cmd* *n* times"""
+    pipeline = Pypeline('bench',fingerprints=None,capture=False)
+    pipeline.add_step(ProcessPypeStep('spawn',[cmd]*n,silent=True,shell_pool=shell_pool))
+    st = time.time()
+    pipeline.run()
+    elapsed = time.time()-st
+    return {'launches':n,
+            'seconds':elapsed,
+            'per_launch_ms':elapsed/n*1e3}
+
+
+def run(n=2000,cmd='/bin/true') :
+    """Benchmark launching *cmd*, a program without shell syntax, *n* times
+    in each mode"""
+    argv = cmd.split()
+    return {'popen':{'shell':launches(lambda: Popen(cmd,shell=True),n),
+                     'argv':launches(lambda: Popen(argv),n),
+                     'popen_command':launches(lambda: popen_command(cmd),n)},
+            # a trailing ; is shell syntax, so forces the /bin/sh path
+            'step':{'shell':step(cmd+';',n),
+                    'direct':step(cmd,n),
+                    'shell_pool':step(cmd,n,shell_pool=True),
+                    'shell_pool_builtin':step('echo',n,shell_pool=True),
+                    'shell_builtin':step('echo;',n)}}
+
+
+if __name__ == '__main__' :
+
+    parser = OptionParser(usage='%prog [options]',description=__doc__)
+    parser.add_option('-n',dest='n',type='int',default=2000,help='number of launches in each mode [default: %default]')
+    parser.add_option('--cmd',dest='cmd',default='/bin/true',help='command to launch, not a shell builtin and without shell syntax [default: %default]')
+    opts, args = parser.parse_args(sys.argv[1:])
+
+    json.dump(run(opts.n,opts.cmd),sys.stdout,indent=2)
+    sys.stdout.write('\n')
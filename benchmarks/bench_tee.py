@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Throughput and latency benchmark for pypeline.Tee, compared with the
+original select()-polling implementation."""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from pypeline import Tee
+
+
+class LegacyTee(threading.Thread) :
+    """The Tee implementation from pypeline 1.2, ported to bytes: polls
+    select() once a second, reads 512 byte chunks, concatenates them and
+    flushes every writer for each chunk."""
+
+    def __init__(self,wlist) :
+        threading.Thread.__init__(self)
+        import select
+        self.select = select.select
+        self.r, self.w = os.pipe()
+        self.in_r = os.fdopen(self.r,'rb',0)
+        self.out_w = os.fdopen(self.w,'w')
+        self.wlist = wlist
+        self.daemon = True
+        self.stop = False
+        self.nbytes = 0
+
+    def run(self) :
+        while not self.stop :
+            self.out_w.flush()
+            i,o,e = self.select([self.in_r],[],[],1)
+            if len(i) == 1 :
+                done = False
+                w_str = b''
+                while not done :
+                    o_str = os.read(i[0].fileno(),512)
+                    if len(o_str) < 512 :
+                        done = True
+                    w_str += o_str
+                self.nbytes += len(w_str)
+                for w in self.wlist :
+                    w.write(w_str)
+                    w.flush()
+
+    def close(self,timeout=None) :
+        self.stop = True
+        self.join(timeout)
+
+
+class TimingSink :
+    """Sink without a file descriptor that records when data arrives"""
+    def __init__(self) :
+        self.times = []
+    def write(self,data) :
+        self.times.append(time.time())
+    def flush(self) :
+        pass
+
+
+def throughput(tee_cls,total_bytes,chunk_size,n_sinks=2) :
+    tmp_fs = [tempfile.TemporaryFile() for _ in range(n_sinks)]
+    tee = tee_cls(tmp_fs)
+    tee.start()
+    chunk = b'x'*(chunk_size-1)+b'\n'
+    n_chunks = total_bytes//chunk_size
+    st = time.time()
+    for _ in range(n_chunks) :
+        os.write(tee.w,chunk)
+    # LegacyTee blocks in read() until it sees a short read
+    os.write(tee.w,b'\n')
+    total = n_chunks*chunk_size+1
+    while tee.nbytes < total :
+        time.sleep(0.001)
+    elapsed = time.time()-st
+    tee.close(timeout=2)
+    for f in tmp_fs :
+        f.close()
+    return {'bytes':total,
+            'seconds':elapsed,
+            'MB_per_sec':total/elapsed/1e6}
+
+
+def latency(tee_cls,n_writes=50,interval=0.01) :
+    sink = TimingSink()
+    tee = tee_cls([sink])
+    tee.start()
+    sent = []
+    for _ in range(n_writes) :
+        sent.append(time.time())
+        os.write(tee.w,b'a line of output\n')
+        while len(sink.times) < len(sent) :
+            time.sleep(0.0001)
+        time.sleep(interval)
+    tee.close(timeout=2)
+    lat = sorted(r-s for s,r in zip(sent,sink.times))
+    return {'writes':n_writes,
+            'median_ms':lat[len(lat)//2]*1e3,
+            'max_ms':lat[-1]*1e3}
+
+
+def run(total_mb=200,chunk_size=512,n_sinks=2,legacy_mb=1) :
+    """Benchmark Tee, and LegacyTee unless *legacy_mb* is 0.  The old
+    implementation is quadratic in the size of a continuous burst of output,
+    so it only gets a small amount of data."""
+    results = {'Tee':{'throughput':throughput(Tee,total_mb*1000000,chunk_size,n_sinks),
+                      'latency':latency(Tee)}}
+    if legacy_mb :
+        results['LegacyTee'] = {'throughput':throughput(LegacyTee,legacy_mb*1000000,chunk_size,n_sinks),
+                                'latency':latency(LegacyTee)}
+    return results
+
+
+if __name__ == '__main__' :
+
+    parser = OptionParser(usage='%prog [options]',description=__doc__)
+    parser.add_option('--mb',dest='mb',type='int',default=200,help='MB of output to forward [default: %default]')
+    parser.add_option('--chunk-size',dest='chunk_size',type='int',default=512,help='size of each write into the Tee [default: %default]')
+    parser.add_option('--sinks',dest='sinks',type='int',default=2,help='number of files the Tee writes to [default: %default]')
+    parser.add_option('--legacy-mb',dest='legacy_mb',type='int',default=1,help='MB of output to forward with the old implementation, 0 to skip it [default: %default]')
+    opts, args = parser.parse_args(sys.argv[1:])
+
+    json.dump(run(opts.mb,opts.chunk_size,opts.sinks,opts.legacy_mb),sys.stdout,indent=2)
+    sys.stdout.write('\n')
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Run the pypeline benchmark suite and write the results as JSON, along
+with the commit and machine they were measured on.  With --compare, also
+print how each timing changed from an earlier results file."""
+
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+from optparse import OptionParser
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,bench_dir)
+import bench_pypeline
+import bench_spawn
+import bench_tee
+
+
+# benchmark name -> (full run kwargs, --quick run kwargs)
+suite = {'pypeline':({},
+                     {'sizes':(10,100,1000,10000),'python_max':1000,'messages':10000,
+                      'spans':(1000,100000)}),
+         'tee':({},
+                {'total_mb':50}),
+         'spawn':({},
+                  {'n':300})}
+modules = {'pypeline':bench_pypeline,'tee':bench_tee,'spawn':bench_spawn}
+
+
+def git_commit() :
+    try :
+        out = subprocess.check_output(['git','rev-parse','HEAD'],cwd=bench_dir,
+                                      stderr=subprocess.DEVNULL)
+        dirty = subprocess.call(['git','diff','--quiet','HEAD'],cwd=bench_dir,
+                                stderr=subprocess.DEVNULL) != 0
+    except (OSError,subprocess.CalledProcessError) :
+        return None
+    return out.decode('ascii').strip()+('-dirty' if dirty else '')
+
+
+def run(names=None,quick=False) :
+    results = {}
+    for name in names or sorted(suite) :
+        kwargs = suite[name][1 if quick else 0]
+        sys.stderr.write('running %s benchmarks\n'%name)
+        results[name] = modules[name].run(**kwargs)
+    return {'meta':{'commit':git_commit(),
+                    'time':datetime.datetime.now().isoformat(),
+                    'python':platform.python_version(),
+                    'platform':platform.platform(),
+                    'cpus':os.cpu_count(),
+                    'quick':quick},
+            'results':results}
+
+
+def timings(d,path=()) :
+    """Yield (path, value) for the timings in results *d*, lists of results
+    are keyed by the size they were measured at"""
+    if isinstance(d,dict) :
+        for k,v in d.items() :
+            for t in timings(v,path+(k,)) :
+                yield t
+    elif isinstance(d,list) :
+        for v in d :
+            size = [v[k] for k in ('steps','span') if isinstance(v,dict) and k in v]
+            for t in timings(v,path+(str(size[0]) if size else '?',)) :
+                yield t
+    elif isinstance(d,(int,float)) and path and \
+         any(path[-1].endswith(s) for s in ('seconds','_ms','_us')) :
+        yield '.'.join(path), d
+
+
+def compare(old,new,out=sys.stdout) :
+    """Print each timing in *new* results that is also in *old*, with the
+    ratio new/old"""
+    old_t = dict(timings(old['results']))
+    out.write('comparing %s with %s\n'%(old['meta'].get('commit'),new['meta'].get('commit')))
+    for path, v in timings(new['results']) :
+        if path in old_t and old_t[path] :
+            out.write('%-70s %12.6g %12.6g %7.2fx\n'%(path,old_t[path],v,v/old_t[path]))
+
+
+if __name__ == '__main__' :
+
+    parser = OptionParser(usage='%prog [options] [benchmark...]',description=__doc__,
+                          epilog='benchmarks: %s'%', '.join(sorted(suite)))
+    parser.add_option('-o','--output',dest='output',default=None,help='write the results to this file instead of stdout')
+    parser.add_option('--quick',dest='quick',action='store_true',help='run smaller versions of the benchmarks')
+    parser.add_option('--compare',dest='compare',default=None,help='results file of an earlier run to compare with')
+    opts, args = parser.parse_args(sys.argv[1:])
+
+    unknown = [a for a in args if a not in suite]
+    if unknown :
+        parser.error('unknown benchmark(s): %s'%', '.join(unknown))
+
+    results = run(args,opts.quick)
+    if opts.output :
+        with open(opts.output,'w') as f :
+            json.dump(results,f,indent=2)
+            f.write('\n')
+    else :
+        json.dump(results,sys.stdout,indent=2)
+        sys.stdout.write('\n')
+    if opts.compare :
+        with open(opts.compare) as f :
+            compare(json.load(f),results,sys.stderr if not opts.output else sys.stdout)
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+from pypeline import Pypeline, ProcessPypeStep, PythonPypeStep
+
+if __name__ == '__main__' :
+
+    pipeline = Pypeline(log='lazy_example.log',max_workers=4)
+
+    # two steps per record, the steps of a record only exist while the run
+    # gets to them; a callable is used instead of a generator so the
+    # pipeline can be run again
+    def record_steps() :
+        for i in range(1000) :
+            record = 'record%04d'%i
+            yield ProcessPypeStep('Compress %s'%record,'echo %s | gzip -c | wc -c'%record,
+                                  depends=[],silent=True)
+            yield PythonPypeStep('Check %s'%record,len,(record,),
+                                 depends=['Compress %s'%record],silent=True)
+    pipeline.add_steps(record_steps,lazy=True)
+
+    # results are handed over as steps finish, nothing piles up
+    n_checked = 0
+    for i, name, result in pipeline.iter_run() :
+        if name.startswith('Check') :
+            n_checked += 1
+    print('checked %d records'%n_checked)
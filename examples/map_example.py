@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+from pypeline import Pypeline, MapPypeStep, PythonPypeStep
+
+if __name__ == '__main__' :
+
+    pipeline = Pypeline(log='map_example.log',journal=True)
+
+    samples = ['sample%02d'%i for i in range(20)]
+
+    # step 1 - one command per sample, four at a time, as a single step
+    pipeline.add_step(MapPypeStep('Count characters','printf {} | wc -c',
+                                  samples,max_procs=4))
+
+    # step 2 - a python function per sample, with retries of failed shards
+    def check(sample) :
+        return len(sample) == 8
+    pipeline.add_step(MapPypeStep('Check names',check,samples,
+                                  max_procs=4,retries=1))
+
+    # step 3 - report the failed shards of step 2, if any; rerun them only
+    # with pipeline.run(resume=True)
+    def report() :
+        failed = pipeline.steps[1].failed_shards()
+        print('failed shards: %s'%(failed or 'none'))
+    pipeline.add_step(PythonPypeStep('Report',report))
+
+    pipeline.run()
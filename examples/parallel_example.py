@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+import sys
+
+from pypeline import Pypeline, ProcessPypeStep, PythonPypeStep
+
+if __name__ == '__main__' :
+
+    # run up to 4 independent steps at the same time
+    pipeline = Pypeline(log='parallel_example.log', max_workers=4)
+
+    # step 0 - make a list of "samples"
+    samples = ['sample%d'%i for i in range(4)]
+    mk_step = ProcessPypeStep('Make sample files',
+                              ['echo %s > %s.txt'%(s,s) for s in samples])
+    pipeline.add_step(mk_step)
+
+    # steps 1-4 - only depend on step 0, run concurrently
+    count_steps = []
+    for s in samples :
+        step = ProcessPypeStep('Count %s'%s,
+                               'sleep 1; wc -c %s.txt > %s.wc'%(s,s),
+                               depends=[mk_step])
+        count_steps.append(step)
+    pipeline.add_steps(count_steps)
+
+    # step 5 - waits for all the counts, dependencies can also be step names
+    pipeline.add_step(ProcessPypeStep('Combine counts','cat *.wc'),
+                      depends=['Count %s'%s for s in samples])
+
+    # step 6 - no depends declared, runs after the step before it
+    pipeline.add_step(ProcessPypeStep('Cleanup','rm -f sample*.txt sample*.wc'))
+
+    # with --plan, only print the predicted schedule from earlier runs
+    if '--plan' in sys.argv[1:] :
+        pipeline.plan()
+    else :
+        pipeline.run()
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+from pypeline import Pypeline, PypelineRunner, ProcessPypeStep
+
+if __name__ == '__main__' :
+
+    # three pipelines, each logging to its own file, whose steps share
+    # two slots
+    runner = PypelineRunner(max_workers=2,policy='fair')
+
+    pipelines = []
+    for name in ('alpha','beta','gamma') :
+        pipeline = Pypeline(name,log='runner_example_%s.log'%name)
+        pipeline.add_steps([ProcessPypeStep('%s %d'%(name,i),'sleep 0.5; echo %s %d'%(name,i),
+                                            depends=[]) for i in range(4)])
+        pipelines.append(pipeline)
+
+    # gamma gets twice the share of the slots of the others
+    results = runner.run([(pipelines[0],0,1),(pipelines[1],0,1),(pipelines[2],0,2)])
+    for pipeline, r in zip(pipelines,results) :
+        print('%s: %s'%(pipeline.name,r))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+from pypeline import Pypeline, ProcessPypeStep, PythonPypeStep
+
+if __name__ == '__main__' :
+
+    pipeline = Pypeline(log='streaming_example.log')
+
+    # the steps of simple_example.py without the intermediate files, the
+    # output of each step is piped into the next one and all of them run
+    # at the same time
+
+    # step 1 - list the current directory
+    ls_step = ProcessPypeStep('Get directory file list','ls -1a')
+    pipeline.add_step(ls_step)
+
+    # step 2 - keep the python files, a python step reading and writing
+    # chunks of bytes
+    def python_files(chunks) :
+        partial = b''
+        for chunk in chunks :
+            lines = (partial+chunk).split(b'\n')
+            partial = lines.pop()
+            yield b''.join(l+b'\n' for l in lines if l.endswith(b'.py'))
+        if partial.endswith(b'.py') :
+            yield partial+b'\n'
+    pipeline.add_step(PythonPypeStep('Python files',python_files,stdin=ls_step))
+
+    # step 3 - sort them
+    pipeline.add_step(ProcessPypeStep('Sort','sort -r',stdin='Python files'))
+
+    # step 4 - runs once the sort is done
+    pipeline.add_step(ProcessPypeStep('Whistle a Happy Tune','echo Whistling a happy tune'))
+
+    pipeline.run()
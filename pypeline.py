@@ -1,11 +1,44 @@
+import asyncio
+import base64
+import bisect
+import codecs
+import cProfile
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
+import inspect
+import itertools
+import io
+import json
+import multiprocessing
 import os
+import pickle
 import re
-import select
+import shlex
+import shutil
+import signal
+import struct
 import sys
+import tempfile
 import textwrap
 import threading
+import time
+import tracemalloc
 
-from subprocess import call
+try :
+    import resource
+except ImportError : # not available on windows
+    resource = None
+
+try :
+    import cloudpickle
+except ImportError : # process pool callables must then be picklable by reference
+    cloudpickle = None
+
+from subprocess import Popen, PIPE
 
 from optparse import IndentedHelpFormatter
 
@@ -39,10 +72,12 @@ except ImportError : # no terminalcontroller package found, replace functions wi
         def msg(x,fd=None) :
             now = datetime.datetime.now()
             fmt_msg = '%s[%s]: %s\n'%(prefix,now.strftime('%Y/%m/%d-%H:%M:%S'),x)
-            sys.stderr.write(fmt_msg)
+            if fd :
+                fd.write(fmt_msg)
             return fmt_msg
         return msg
 
+    announce = make_msg_call('ANNOUNCE')
     debug = make_msg_call('DEBUG')
     info = make_msg_call('INFO')
     warn = make_msg_call('WARN')
@@ -53,41 +88,265 @@ def write_identity(st,fd=None) :
         fd.write(st)
     return st
 
+def _write_all(fd,data) :
+    """os.write() all of *data* to *fd*, retrying on short writes"""
+    while data :
+        n = os.write(fd,data)
+        data = data[n:]
+
+
 class Tee(threading.Thread) :
+    """Thread that forwards everything written to its pipe, *out_w*, to each
+    of the file objects in *wlist*.
 
-    def __init__(self,wlist,group=None, target=None, name=None, args=(), kwargs={}) :
+    Reads block on the pipe and pick up everything available, up to
+    *bufsize* bytes, into a single reusable buffer that is written to each
+    sink with one os.write() call.  Sinks without a file descriptor (e.g.
+    io.StringIO) are written through their write() method instead.  When the
+    only sink is a regular file, data is moved with os.splice() and never
+    copied into the process.  Call close() to drain the pipe and stop the
+    thread."""
+
+    bufsize = 1<<17
+
+    def __init__(self,wlist,group=None, target=None, name=None, args=(), kwargs={}, bufsize=None) :
         threading.Thread.__init__(self,group,target,name,args,kwargs)
         self.r, self.w = os.pipe()
-        self.in_r = os.fdopen(self.r,'r')
+        self.in_r = os.fdopen(self.r,'rb',0)
         self.out_w = os.fdopen(self.w,'w')
         self.wlist = wlist
         self.daemon = True
-        self.stop = False
+        self.bufsize = bufsize or self.bufsize
+        self.nbytes = 0
+        self._set_pipe_size(self.w,self.bufsize)
+
+    @staticmethod
+    def _set_pipe_size(fd,size) :
+        try :
+            import fcntl
+            fcntl.fcntl(fd,getattr(fcntl,'F_SETPIPE_SZ',1031),size)
+        except (ImportError,IOError,OSError) :
+            pass # not linux, or over /proc/sys/fs/pipe-max-size
+
+    def _sinks(self) :
+        """Return (fd, file object) pairs for wlist, fd is None for file
+        objects that aren't backed by a file descriptor"""
+        sinks = []
+        for w in self.wlist :
+            try :
+                sinks.append((w.fileno(),w))
+            except (AttributeError,IOError,ValueError) : # io.UnsupportedOperation
+                sinks.append((None,w))
+        return sinks
+
+    def _splice_target(self,sinks) :
+        if len(sinks) != 1 or sinks[0][0] is None or not hasattr(os,'splice') :
+            return None
+        fd = sinks[0][0]
+        try :
+            import fcntl, stat
+            if not stat.S_ISREG(os.fstat(fd).st_mode) :
+                return None
+            if fcntl.fcntl(fd,fcntl.F_GETFL) & os.O_APPEND : # EINVAL for splice
+                return None
+        except (ImportError,OSError) :
+            return None
+        return fd
 
     def run(self) :
-        while not self.stop :
-            self.out_w.flush()
-            i,o,e = select.select([self.in_r],[],[],1)
-            if len(i) == 1 :
-                done = False
-                w_str = ''
-                while not done :
-                    o_str = os.read(i[0].fileno(),512)
-                    if len(o_str) < 512 :
-                        done = True
-                    w_str += o_str
-                for w in self.wlist :
-                    w.write(w_str)
-                    w.flush()
+        sinks = self._sinks()
+        splice_fd = self._splice_target(sinks)
+        if splice_fd is not None :
+            self._run_splice(splice_fd)
+        else :
+            self._run_copy(sinks)
         self.in_r.close()
-        self.out_w.close()
+
+    def _run_splice(self,fd) :
+        while True :
+            n = os.splice(self.r,fd,self.bufsize)
+            if n == 0 :
+                break
+            self.nbytes += n
+
+    def _run_copy(self,sinks) :
+        buf = bytearray(self.bufsize)
+        view = memoryview(buf)
+        decoders = {}
+        while True :
+            n = self.in_r.readinto(buf)
+            if not n : # EOF, every write end of the pipe is closed
+                break
+            self.nbytes += n
+            chunk = view[:n]
+            for fd, w in sinks :
+                if fd is not None :
+                    _write_all(fd,chunk)
+                elif isinstance(w,io.TextIOBase) :
+                    if id(w) not in decoders :
+                        decoders[id(w)] = codecs.getincrementaldecoder('utf-8')('replace')
+                    w.write(decoders[id(w)].decode(chunk))
+                else :
+                    w.write(bytes(chunk))
+
+    def close(self,timeout=None) :
+        """Close the write end of the pipe and wait up to *timeout* seconds
+        for everything written so far to be forwarded.  Returns True if the
+        thread finished, False if the pipe is still held open elsewhere
+        (e.g. by a backgrounded child process)."""
+        if not self.out_w.closed :
+            self.out_w.close()
+        if self.is_alive() :
+            self.join(timeout)
+        return not self.is_alive()
+
+class StepList :
+    """Set of step indices kept as sorted, disjoint [start, stop) intervals,
+    so a span like 0-99999 takes constant space.  Membership is a binary
+    search over the intervals, iteration yields the indices in order, and
+    |, & and - work on other StepLists or iterables of indices.  Behaves
+    like the sorted list parse_steplist() used to return: it can be
+    indexed, and compares equal to a list of the same indices."""
+
+    __slots__ = ('_starts','_stops')
+
+    def __init__(self,steps=()) :
+        self._starts, self._stops = [], []
+        if isinstance(steps,StepList) :
+            self._starts, self._stops = list(steps._starts), list(steps._stops)
+        elif isinstance(steps,range) and steps.step == 1 :
+            self.add_range(steps.start,steps.stop)
+        else :
+            starts, stops = self._starts, self._stops
+            for i in sorted(set(steps)) :
+                if stops and stops[-1] == i :
+                    stops[-1] = i+1
+                else :
+                    starts.append(i)
+                    stops.append(i+1)
+
+    @classmethod
+    def from_ranges(cls,ranges) :
+        """StepList of the union of the [start, stop) pairs in *ranges*"""
+        steplist = cls()
+        starts, stops = steplist._starts, steplist._stops
+        for start, stop in sorted(ranges) :
+            if start >= stop :
+                continue
+            if stops and start <= stops[-1] :
+                stops[-1] = max(stops[-1],stop)
+            else :
+                starts.append(start)
+                stops.append(stop)
+        return steplist
+
+    def ranges(self) :
+        """Return the [start, stop) intervals as a list of pairs"""
+        return list(zip(self._starts,self._stops))
+
+    def add_range(self,start,stop) :
+        """Add the indices from *start* up to, not including, *stop*"""
+        if start >= stop :
+            return
+        # intervals overlapping or touching [start, stop) are merged
+        lo = bisect.bisect_left(self._stops,start)
+        hi = bisect.bisect_right(self._starts,stop)
+        if lo < hi :
+            start = min(start,self._starts[lo])
+            stop = max(stop,self._stops[hi-1])
+        self._starts[lo:hi] = [start]
+        self._stops[lo:hi] = [stop]
+
+    def add(self,i) :
+        self.add_range(i,i+1)
+
+    def sort(self) :
+        pass # always sorted, kept for code written for lists
+
+    def __contains__(self,i) :
+        k = bisect.bisect_right(self._starts,i)-1
+        return k >= 0 and i < self._stops[k]
+
+    def __iter__(self) :
+        for start, stop in zip(self._starts,self._stops) :
+            for i in range(start,stop) :
+                yield i
+
+    def __len__(self) :
+        return sum(stop-start for start, stop in zip(self._starts,self._stops))
+
+    def __bool__(self) :
+        return bool(self._starts)
+
+    def __getitem__(self,k) :
+        if isinstance(k,slice) :
+            return list(self)[k]
+        if k < 0 :
+            k += len(self)
+        if k >= 0 :
+            for start, stop in zip(self._starts,self._stops) :
+                if k < stop-start :
+                    return start+k
+                k -= stop-start
+        raise IndexError('StepList index out of range')
+
+    def __or__(self,other) :
+        return StepList.from_ranges(self.ranges()+StepList(other).ranges())
+
+    def __and__(self,other) :
+        a, b = self.ranges(), StepList(other).ranges()
+        result, i, j = [], 0, 0
+        while i < len(a) and j < len(b) :
+            start, stop = max(a[i][0],b[j][0]), min(a[i][1],b[j][1])
+            if start < stop :
+                result.append((start,stop))
+            if a[i][1] < b[j][1] :
+                i += 1
+            else :
+                j += 1
+        return StepList.from_ranges(result)
+
+    def __sub__(self,other) :
+        b = StepList(other).ranges()
+        result, j = [], 0
+        for start, stop in self.ranges() :
+            while j < len(b) and b[j][1] <= start :
+                j += 1
+            k = j
+            while k < len(b) and b[k][0] < stop :
+                if b[k][0] > start :
+                    result.append((start,b[k][0]))
+                start = max(start,b[k][1])
+                k += 1
+            if start < stop :
+                result.append((start,stop))
+        return StepList.from_ranges(result)
+
+    def __eq__(self,other) :
+        if isinstance(other,StepList) :
+            return self.ranges() == other.ranges()
+        try :
+            return list(self) == list(other)
+        except TypeError :
+            return NotImplemented
+
+    __hash__ = None
+
+    def __str__(self) :
+        """The steplist in the format parse_steplist() reads, e.g. 0-3,5"""
+        return ','.join(str(start) if stop == start+1 else '%d-%d'%(start,stop-1)
+                        for start, stop in zip(self._starts,self._stops))
+
+    def __repr__(self) :
+        return 'StepList(%r)'%str(self)
+
 
 def parse_steplist_str(steplist_str) :
 
     if steplist_str is None or len(steplist_str.strip()) == 0 :
-        steplist = []
+        steplist = StepList()
     else :
-        steplist = []
+        steplist = StepList()
         for arg in steplist_str.split(',') :
             if arg.find('-') != -1 : # we have a span argument
                 st,sp = arg.split('-')
@@ -96,23 +355,23 @@ def parse_steplist_str(steplist_str) :
                 except :
                     raise Exception('Invalid span argument, aborting: %s'%arg)
                     sys.exit(1)
-                steplist.extend(range(st,sp+1))
+                steplist.add_range(st,sp+1)
             else :
                 try :
                     st = int(arg)
                 except :
                     raise Exception('Invalid span argument, aborting: %s'%arg)
                     sys.exit(1)
-                steplist.append(st)
+                steplist.add(st)
 
     return steplist
 
 def parse_steplist(steplist_str,pipeline) :
 
     if steplist_str.strip() == '' :
-        steplist = range(len(pipeline.steps))
+        steplist = StepList(range(len(pipeline.steps)))
     else :
-        steplist = []
+        steplist = StepList()
         for arg in steplist_str.split(',') :
             if arg.find('-') != -1 : # we have a span argument
                 st,sp = arg.split('-')
@@ -121,14 +380,14 @@ def parse_steplist(steplist_str,pipeline) :
                 except :
                     pipeline.error('Invalid span argument, aborting: %s'%arg)
                     sys.exit(1)
-                steplist.extend(range(st,sp+1))
+                steplist.add_range(st,sp+1)
             else :
                 try :
                     st = int(arg)
                 except :
                     pipeline.error('Invalid span argument, aborting: %s'%arg)
                     sys.exit(1)
-                steplist.append(st)
+                steplist.add(st)
 
     steplist.sort()
 
@@ -137,8 +396,13 @@ def parse_steplist(steplist_str,pipeline) :
 
 def get_steplist(pipeline) :
 
+    history = getattr(pipeline,'history',None)
     for i,s in enumerate(pipeline.steps) :
-        pipeline.printout('%d: %s\n'%(i,s.name))
+        predicted = history.predict(s) if history is not None else None
+        if predicted is None :
+            pipeline.printout('%d: %s\n'%(i,s.name))
+        else :
+            pipeline.printout('%d: %s (~%s)\n'%(i,s.name,format_seconds(predicted)))
 
     prompt = 'Execute which steps (e.g. 1-2,4,6) [all]:'
 
@@ -156,9 +420,1882 @@ def get_steplist(pipeline) :
 class PypelineException(Exception) : pass
 
 
+def format_seconds(seconds) :
+    """Format a duration like 4.2s, 3m12s or 2h05m"""
+    if seconds < 60 :
+        return '%.1fs'%seconds
+    minutes, seconds = divmod(int(round(seconds)),60)
+    if minutes < 60 :
+        return '%dm%02ds'%(minutes,seconds)
+    return '%dh%02dm'%divmod(minutes,60)
+
+
+RUSAGE_FIELDS = ('ru_utime','ru_stime','ru_maxrss','ru_minflt','ru_majflt',
+                 'ru_inblock','ru_oublock','ru_nvcsw','ru_nivcsw')
+
+def rusage_dict(ru) :
+    """Convert a resource.struct_rusage into a dict with the fields in
+    RUSAGE_FIELDS, ru_maxrss is in kilobytes on linux"""
+    if ru is None :
+        return None
+    return dict((f,getattr(ru,f)) for f in RUSAGE_FIELDS)
+
+def sum_rusage(rusages) :
+    """Add up rusage dicts, taking the maximum of ru_maxrss"""
+    total = None
+    for ru in rusages :
+        if ru is None :
+            continue
+        if total is None :
+            total = dict(ru)
+            continue
+        for f in RUSAGE_FIELDS :
+            total[f] = max(total[f],ru[f]) if f == 'ru_maxrss' else total[f]+ru[f]
+    return total
+
+def _exit_code(status) :
+    if os.WIFSIGNALED(status) :
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+# words that only mean something to a shell, commands starting with them
+# are run by /bin/sh
+_shell_words = frozenset(['!','.','alias','case','cd','declare','eval','exec',
+                          'exit','export','for','function','if','local','read',
+                          'readonly','return','set','shift','source','trap',
+                          'ulimit','umask','unset','until','wait','while','{'])
+_shell_syntax_re = re.compile(r'[|&;<>()$`*?\[\]{}~#]')
+_assignment_re = re.compile(r'^[A-Za-z_]\w*=')
+# quoted strings and escapes are kept as they are, other whitespace collapsed
+_whitespace_re = re.compile(r'''('[^']*'|"(?:\\.|[^"\\])*"|\\.)|\s+''',re.S)
+
+def command_argv(cmd) :
+    """Return the argv list to exec the command *cmd* with, a string or an
+    argv list/tuple, or None if *cmd* is a string using shell syntax
+    (pipes, redirection, variables, globs, builtins...)"""
+    if not isinstance(cmd,str) :
+        return list(cmd)
+    if _shell_syntax_re.search(cmd) :
+        return None
+    if '\\\n' in cmd :
+        # line continuations, removed by the shell except in single quotes
+        if "'" in cmd :
+            return None
+        cmd = cmd.replace('\\\n','')
+    try :
+        argv = shlex.split(cmd)
+    except ValueError : # unbalanced quotes, let the shell complain
+        return None
+    if not argv or argv[0] in _shell_words or _assignment_re.match(argv[0]) :
+        return None
+    return argv
+
+def command_str(cmd) :
+    """Return the command *cmd* as a string for messages"""
+    return cmd if isinstance(cmd,str) else shlex.join(cmd)
+
+def _collapse_whitespace(cmd) :
+    """Join the lines of a shell command and squeeze runs of whitespace,
+    leaving quoted arguments untouched"""
+    return _whitespace_re.sub(lambda m: m.group(1) or ' ',cmd).strip()
+
+@functools.lru_cache(maxsize=1024)
+def _which(name,path) :
+    return shutil.which(name,path=path)
+
+def popen_command(cmd,env=None,**popen_kwargs) :
+    """Start the command *cmd* (see command_argv) with subprocess.Popen,
+    exec'ing it directly unless it needs a shell.  A program that can't be
+    found is left to /bin/sh, which reports it and exits with 127."""
+    argv = command_argv(cmd)
+    if argv is not None :
+        exe = argv[0]
+        if os.sep not in exe :
+            # the PATH the child, and a shell started instead, would get
+            path = os.environ.get('PATH',os.defpath) if env is None else env.get('PATH') or os.defpath
+            exe = _which(exe,path)
+        if exe is not None :
+            try :
+                return Popen(argv,executable=exe,env=env,**popen_kwargs)
+            except (FileNotFoundError,PermissionError) :
+                pass
+    if isinstance(cmd,str) :
+        cmd = _collapse_whitespace(cmd)
+    else :
+        cmd = shlex.join(cmd)
+    return Popen(cmd,shell=True,env=env,**popen_kwargs)
+
+def wait_rusage(p,cmd,st) :
+    """Wait for the subprocess.Popen *p*, started at time *st*, and return
+    its exit code along with a dict of its wall time and resource usage,
+    collected with os.wait4()"""
+    ru = None
+    if hasattr(os,'wait4') :
+        try :
+            pid, status, ru = os.wait4(p.pid,0)
+            p.returncode = _exit_code(status)
+        except BaseException :
+            p.kill()
+            p.wait()
+            raise
+    else :
+        p.wait()
+    stats = {'cmd':cmd,
+             'returncode':p.returncode,
+             'start':st,
+             'wall':time.time()-st,
+             'rusage':rusage_dict(ru)}
+    return p.returncode, stats
+
+def terminate_process(p,sig=signal.SIGTERM) :
+    """Send *sig*, SIGTERM by default, to the subprocess.Popen *p*, and to
+    its whole process group if it leads one (e.g. started with
+    start_new_session=True)"""
+    if not isinstance(p,Popen) : # e.g. RemoteCall
+        p.terminate()
+        return
+    try :
+        if hasattr(os,'killpg') and os.getpgid(p.pid) == p.pid :
+            os.killpg(p.pid,sig)
+        else :
+            p.send_signal(sig)
+    except OSError : # already exited
+        pass
+
+def _has_exited(p) :
+    """Whether the subprocess.Popen *p* has exited, without reaping it"""
+    if p.returncode is not None :
+        return True
+    if not hasattr(os,'waitid') :
+        return p.poll() is not None
+    try :
+        return os.waitid(os.P_PID,p.pid,os.WEXITED|os.WNOHANG|os.WNOWAIT) is not None
+    except ChildProcessError :
+        return True
+
+async def terminate_process_async(p,cmd,st,grace=5.) :
+    """Terminate the subprocess.Popen *p*, kill it if it is still running
+    *grace* seconds later, and reap it, without blocking the event loop
+    while it handles SIGTERM.  Returns what wait_rusage() returns."""
+    terminate_process(p)
+    try :
+        deadline = time.time()+grace
+        while not _has_exited(p) and time.time() < deadline :
+            await asyncio.sleep(0.05)
+    finally : # also when cancelled again
+        if not _has_exited(p) :
+            terminate_process(p,signal.SIGKILL)
+    return wait_rusage(p,cmd,st)
+
+def _set_future(fut,result=None,exc=None) :
+    if not fut.done() :
+        if exc is not None :
+            fut.set_exception(exc)
+        else :
+            fut.set_result(result)
+
+def run_in_thread(fn,*args,**kwargs) :
+    """Call the blocking callable *fn* in a new daemon thread and return an
+    asyncio future for its result.  Unlike loop.run_in_executor(), a step
+    that never returns does not keep the interpreter from exiting."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    def target() :
+        try :
+            r, exc = fn(*args,**kwargs), None
+        except BaseException as e :
+            r, exc = None, e
+        try :
+            loop.call_soon_threadsafe(_set_future,fut,r,exc)
+        except RuntimeError : # event loop already closed
+            pass
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+    return fut
+
+def _run_awaitable(aw) :
+    """asyncio.run() the awaitable *aw*, in a thread of its own if an event
+    loop already runs in this one"""
+    async def wait() :
+        return await aw
+    try :
+        asyncio.get_running_loop()
+    except RuntimeError :
+        return asyncio.run(wait())
+    with concurrent.futures.ThreadPoolExecutor(1) as executor :
+        return executor.submit(asyncio.run,wait()).result()
+
+def _check_no_running_loop(what) :
+    """Raise a PypelineException if called from a running event loop,
+    which the blocking *what* cannot run in"""
+    try :
+        asyncio.get_running_loop()
+    except RuntimeError :
+        return
+    raise PypelineException('%s cannot be called from a running event loop (e.g. in a '
+                            'notebook or async code), use run_async() instead'%what)
+
+async def wait_rusage_async(p,cmd,st) :
+    """Coroutine version of wait_rusage().  The event loop watches a pidfd
+    for the exit of *p* where available (linux), otherwise a thread waits
+    for it.  If cancelled, *p* is terminated, see terminate_process_async()."""
+    pidfd = None
+    if hasattr(os,'pidfd_open') :
+        try :
+            pidfd = os.pidfd_open(p.pid)
+        except OSError :
+            pass
+    loop = asyncio.get_running_loop()
+    if pidfd is None :
+        try :
+            return await run_in_thread(wait_rusage,p,cmd,st)
+        except asyncio.CancelledError :
+            # the thread reaps it
+            terminate_process(p)
+            loop.call_later(5.,lambda: p.returncode is None and
+                                       terminate_process(p,signal.SIGKILL))
+            raise
+
+    exited = loop.create_future()
+    loop.add_reader(pidfd,_set_future,exited)
+    try :
+        await exited
+    except asyncio.CancelledError :
+        await terminate_process_async(p,cmd,st)
+        raise
+    finally :
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    return wait_rusage(p,cmd,st)
+
+def _dumps_call(fn,args,kwargs) :
+    """Pickle a call for _pool_call(), with cloudpickle if installed so
+    lambdas and closures can be sent too"""
+    dumps = cloudpickle.dumps if cloudpickle is not None else pickle.dumps
+    return dumps((fn,tuple(args),dict(kwargs)))
+
+def _close_fds(fds) :
+    for fd in fds :
+        try :
+            os.close(fd)
+        except OSError :
+            pass
+
+def _pool_call(payload,pid_path=None) :
+    """Run a call pickled by _dumps_call() in a process pool worker with
+    file descriptors 1 and 2 redirected to temporary files.  Returns
+    (result, exception, stdout bytes, stderr bytes, stats), the exception
+    being None unless the call raised one.  The worker's pid is written to
+    *pid_path* first, so a call that times out can be killed."""
+    if pid_path :
+        with open(pid_path,'w') as f :
+            f.write(str(os.getpid()))
+    st = time.time()
+    ru_st = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    files = [tempfile.TemporaryFile(),tempfile.TemporaryFile()]
+    saved = [os.dup(1),os.dup(2)]
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(files[0].fileno(),1)
+    os.dup2(files[1].fileno(),2)
+    r = exc = None
+    try :
+        fn, args, kwargs = pickle.loads(payload)
+        r = fn(*args,**kwargs)
+        if inspect.isawaitable(r) :
+            r = asyncio.run(r)
+    except Exception as e :
+        exc = e
+    finally :
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in ((1,saved[0]),(2,saved[1])) :
+            os.dup2(saved_fd,fd)
+            os.close(saved_fd)
+    output = []
+    for f in files :
+        f.seek(0)
+        output.append(f.read())
+        f.close()
+    if exc is not None :
+        try :
+            pickle.dumps(exc)
+        except Exception :
+            exc = PypelineException('%s: %s'%(exc.__class__.__name__,exc))
+    rusage = None
+    if ru_st is not None :
+        ru_end = resource.getrusage(resource.RUSAGE_SELF)
+        rusage = dict((f,getattr(ru_end,f) if f == 'ru_maxrss' else
+                         getattr(ru_end,f)-getattr(ru_st,f)) for f in RUSAGE_FIELDS)
+    stats = {'returncode':0 if exc is None else 1,
+             'start':st,
+             'wall':time.time()-st,
+             'rusage':rusage,
+             'pid':os.getpid()}
+    return r, exc, output[0], output[1], stats
+
+def iter_chunks(fd,size=1<<16) :
+    """Generator of the chunks of bytes read from *fd* until EOF"""
+    while True :
+        data = os.read(fd,size)
+        if not data :
+            return
+        yield data
+
+def write_chunks(chunks,fd) :
+    """Write each chunk of bytes, or str encoded as utf-8, from the
+    iterator *chunks* to *fd*.  Returns the return value of *chunks* if it
+    is a generator, stops early if the reading end of *fd* is closed."""
+    try :
+        while True :
+            chunk = next(chunks)
+            if isinstance(chunk,str) :
+                chunk = chunk.encode('utf-8')
+            _write_all(fd,chunk)
+    except StopIteration as e :
+        return e.value
+    except BrokenPipeError :
+        if hasattr(chunks,'close') :
+            chunks.close()
+        return None
+
+class StepOutput :
+    """Bounded capture of one output stream of a step.  The last *size*
+    bytes written are kept in memory in a ring buffer.  Once more than
+    *size* bytes have been written, the whole stream is also written to the
+    file *path*, so memory use stays flat however much is written.  *path*
+    may be a callable returning the path, called when the output spills."""
+
+    def __init__(self,path,size=1<<18) :
+        self.path = path
+        self.size = size
+        self.nbytes = 0
+        self.spilled = False
+        self._ring = bytearray()
+        self._pos = 0 # start of the oldest data once the ring is full
+        self._f = None
+
+    def write(self,data) :
+        if self.nbytes+len(data) > self.size and self._f is None :
+            self._spill()
+        if self._f is not None :
+            self._f.write(data)
+        self.nbytes += len(data)
+        self._ring_write(data)
+
+    def _ring_write(self,data) :
+        size = self.size
+        if len(self._ring) < size : # not full yet, grow
+            n = min(len(data),size-len(self._ring))
+            self._ring += data[:n]
+            data = data[n:]
+        if not data :
+            return
+        if len(data) >= size :
+            self._ring[:] = data[-size:]
+            self._pos = 0
+            return
+        end = self._pos+len(data)
+        if end <= size :
+            self._ring[self._pos:end] = data
+        else :
+            k = size-self._pos
+            self._ring[self._pos:] = data[:k]
+            self._ring[:end-size] = data[k:]
+        self._pos = end%size
+
+    def _spill(self) :
+        if callable(self.path) :
+            self.path = self.path()
+        d = os.path.dirname(self.path)
+        if d and not os.path.isdir(d) :
+            os.makedirs(d)
+        self._f = open(self.path,'wb')
+        self._f.write(self.tail())
+        self.spilled = True
+
+    def tail(self,n=None) :
+        """Return the last *n* bytes written (at most *size*), all of the
+        buffered bytes by default"""
+        data = bytes(self._ring[self._pos:]+self._ring[:self._pos])
+        return data if n is None else data[-n:]
+
+    def read(self) :
+        """Return everything written, read back from the spill file if the
+        output did not fit in memory"""
+        if not self.spilled :
+            return self.tail()
+        if self._f is not None :
+            self._f.flush()
+        with open(self.path,'rb') as f :
+            return f.read()
+
+    def text(self,n=None) :
+        return self.tail(n).decode('utf-8','replace')
+
+    def eof(self) :
+        if self._f is not None :
+            self._f.flush()
+
+    def close(self) :
+        if self._f is not None :
+            self._f.close()
+            self._f = None
+
+
+class _FdWriter :
+    """Writer for the output forwarding functions that writes to a file
+    descriptor, e.g. the pipeline's Tee pipe"""
+
+    def __init__(self,fd) :
+        self.fd = fd
+
+    def write(self,data) :
+        _write_all(self.fd,data)
+
+    def eof(self) :
+        pass
+
+
+class _LinePrefixer :
+    """Writer that passes data on to the writers in *outs* with *prefix* at
+    the start of every line"""
+
+    max_line = 1<<16
+
+    def __init__(self,outs,prefix) :
+        self.outs = outs
+        self.prefix = prefix
+        self.partial = b''
+
+    def write(self,data) :
+        data = self.partial+data
+        end = data.rfind(b'\n')+1
+        if end == 0 and len(data) < self.max_line :
+            self.partial = data
+            return
+        if end == 0 : # overly long line, pass on what we have
+            data += b'\n'
+            end = len(data)
+        self.partial = data[end:]
+        lines = data[:end-1].split(b'\n')
+        out = b''.join(self.prefix+l+b'\n' for l in lines)
+        for w in self.outs :
+            w.write(out)
+
+    def eof(self) :
+        if self.partial :
+            out = self.prefix+self.partial+b'\n'
+            self.partial = b''
+            for w in self.outs :
+                w.write(out)
+        for w in self.outs :
+            w.eof()
+
+async def _forward_output(r_fd,outs) :
+    """Copy everything read from pipe *r_fd* to each writer in *outs* until
+    EOF, then call their eof() methods"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=1<<17)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                os.fdopen(r_fd,'rb',0))
+    try :
+        while True :
+            data = await reader.read(1<<16)
+            if not data :
+                break
+            for w in outs :
+                w.write(data)
+    finally :
+        transport.close()
+        for w in outs :
+            w.eof()
+
+
+# Remote workers: a worker (see serve_worker() and scripts/pypeline_worker.py)
+# runs the commands of ProcessPypeSteps sent to it over a socket.  Every
+# message is a frame of two 4 byte big-endian lengths, a JSON header and a
+# raw payload.  A connection runs one command:
+#   client -> worker  {"type":"exec","token":...,"cmd":...,"env":{...},"cwd":...}
+#   worker -> client  {"type":"output","stream":"stdout"|"stderr"} + data
+#   client -> worker  {"type":"kill"} to terminate the command
+#   worker -> client  {"type":"exit","returncode":...,"rusage":{...},"wall":...}
+# or {"type":"error","message":...} if the command could not be run.
+
+_frame_lengths = struct.Struct('>II')
+
+def _pack_frame(header,payload=b'') :
+    header = json.dumps(header).encode('utf-8')
+    return _frame_lengths.pack(len(header),len(payload))+header+payload
+
+async def _read_frame(reader) :
+    """Return the (header, payload) of the next frame from the asyncio
+    StreamReader *reader*, or (None, None) at EOF"""
+    try :
+        lengths = await reader.readexactly(_frame_lengths.size)
+    except asyncio.IncompleteReadError :
+        return None, None
+    h_len, p_len = _frame_lengths.unpack(lengths)
+    header = json.loads((await reader.readexactly(h_len)).decode('utf-8'))
+    payload = await reader.readexactly(p_len) if p_len else b''
+    return header, payload
+
+def _parse_address(address) :
+    """Split 'host:port' into (host, port), a path is a unix socket"""
+    if isinstance(address,tuple) :
+        return address
+    if ':' in address :
+        host, port = address.rsplit(':',1)
+        return host, int(port)
+    return address, None
+
+
+class RemoteCall :
+    """Handle on a command running on a remote worker, terminate() asks the
+    worker to stop it"""
+
+    def __init__(self,address,writer) :
+        self.address = address
+        self.writer = writer
+
+    def terminate(self) :
+        try :
+            self.writer.write(_pack_frame({'type':'kill'}))
+        except (OSError,RuntimeError) :
+            pass
+
+
+class WorkerPool :
+    """Remote workers that ProcessPypeStep commands can be sent to, given as
+    'host:port' strings or unix socket paths.  Each command goes to the
+    worker with the fewest commands in flight per slot, workers that can't
+    be reached are skipped.  *token* must match the workers' token."""
+
+    def __init__(self,addresses,token=None,slots=1) :
+        self.addresses = list(addresses)
+        self.token = token if token is not None else os.environ.get('PYPELINE_WORKER_TOKEN')
+        self.slots = dict((a,slots) for a in self.addresses)
+        self.in_flight = dict((a,0) for a in self.addresses)
+        self.down = set()
+
+    def _ranked(self) :
+        up = [a for a in self.addresses if a not in self.down] or self.addresses
+        return sorted(up,key=lambda a: self.in_flight[a]/float(self.slots[a]))
+
+    async def _connect(self) :
+        errors = []
+        for address in self._ranked() :
+            host, port = _parse_address(address)
+            try :
+                if port is None :
+                    reader, writer = await asyncio.open_unix_connection(host)
+                else :
+                    reader, writer = await asyncio.open_connection(host,port)
+            except OSError as e :
+                self.down.add(address)
+                errors.append('%s: %s'%(address,e))
+                continue
+            self.down.discard(address)
+            return address, reader, writer
+        raise PypelineException('No remote worker reachable: %s'%'; '.join(errors))
+
+    async def spawn(self,cmd,env,outs,cwd=None) :
+        """Start *cmd* on a worker and return a RemoteCall along with a
+        coroutine that forwards its output to the (stdout, stderr) writer
+        lists *outs* and returns its exit code and stats, like
+        wait_rusage_async()"""
+        address, reader, writer = await self._connect()
+        self.in_flight[address] += 1
+        st = time.time()
+        writer.write(_pack_frame({'type':'exec','token':self.token,'cmd':cmd,
+                                  'env':env,'cwd':cwd or os.getcwd()}))
+        handle = RemoteCall(address,writer)
+
+        async def wait() :
+            streams = {'stdout':outs[0],'stderr':outs[1]}
+            try :
+                while True :
+                    header, payload = await _read_frame(reader)
+                    if header is None :
+                        raise PypelineException('Worker %s closed the connection '
+                                                'while running: %s'%(address,cmd))
+                    if header['type'] == 'output' :
+                        for w in streams[header['stream']] :
+                            w.write(payload)
+                    elif header['type'] == 'exit' :
+                        break
+                    else :
+                        raise PypelineException('Worker %s could not run %s: %s'%(
+                                                address,cmd,header.get('message')))
+            except asyncio.CancelledError :
+                handle.terminate()
+                raise
+            finally :
+                self.in_flight[address] -= 1
+                for ws in streams.values() :
+                    for w in ws :
+                        w.eof()
+                writer.close()
+            stats = {'cmd':cmd,
+                     'returncode':header['returncode'],
+                     'start':st,
+                     'wall':time.time()-st,
+                     'rusage':header.get('rusage'),
+                     'worker':address}
+            return header['returncode'], stats
+        return handle, wait()
+
+
+class _FrameWriter :
+    """Writer sending output to a worker's client as frames"""
+
+    def __init__(self,writer,stream) :
+        self.writer = writer
+        self.stream = stream
+
+    def write(self,data) :
+        self.writer.write(_pack_frame({'type':'output','stream':self.stream},data))
+
+    def eof(self) :
+        pass
+
+async def _serve_worker_connection(reader,writer,token,slots) :
+    peer = writer.get_extra_info('peername')
+    try :
+        header, payload = await _read_frame(reader)
+        if header is None or header.get('type') != 'exec' :
+            return
+        if token and not hmac.compare_digest(str(header.get('token')),token) :
+            writer.write(_pack_frame({'type':'error','message':'bad token'}))
+            return
+        async with slots :
+            cmd = header['cmd']
+            st = time.time()
+            pipes = [os.pipe(),os.pipe()]
+            try :
+                p = popen_command(cmd,env=header.get('env'),
+                          cwd=header.get('cwd'),stdout=pipes[0][1],stderr=pipes[1][1],
+                          start_new_session=True)
+            except OSError as e :
+                for r_fd, w_fd in pipes :
+                    os.close(r_fd)
+                writer.write(_pack_frame({'type':'error','message':str(e)}))
+                return
+            finally :
+                for r_fd, w_fd in pipes :
+                    os.close(w_fd)
+
+            async def watch_kill() :
+                header, payload = await _read_frame(reader)
+                # a kill message, or the client going away
+                terminate_process(p)
+            killer = asyncio.ensure_future(watch_kill())
+            try :
+                await asyncio.gather(_forward_output(pipes[0][0],[_FrameWriter(writer,'stdout')]),
+                                     _forward_output(pipes[1][0],[_FrameWriter(writer,'stderr')]))
+                r, stats = await wait_rusage_async(p,cmd,st)
+            finally :
+                killer.cancel()
+            writer.write(_pack_frame({'type':'exit','returncode':r,
+                                      'rusage':stats['rusage'],'wall':stats['wall']}))
+            await writer.drain()
+    except (OSError,ValueError,asyncio.IncompleteReadError) as e :
+        sys.stderr.write('pypeline worker: connection from %s failed: %s\n'%(peer,e))
+    finally :
+        writer.close()
+
+async def serve_worker(address='127.0.0.1:8765',token=None,slots=None) :
+    """Serve commands sent by WorkerPool clients on *address*, a 'host:port'
+    string or unix socket path, running at most *slots* (default: number of
+    cpus) at once.  If *token* is set clients must send the same token.
+    Anyone able to connect runs commands as the worker's user, so a TCP
+    address needs a token, and unix sockets are only accessible to that
+    user."""
+    host, port = _parse_address(address)
+    if port is not None and not token :
+        raise PypelineException('Refusing to serve commands on %s without a token, '
+                                'set one or use a unix socket path'%address)
+    slots = asyncio.Semaphore(slots or os.cpu_count() or 1)
+    handler = functools.partial(_serve_worker_connection,token=token,slots=slots)
+    if port is None :
+        umask = os.umask(0o177) # socket created with mode 0600
+        try :
+            server = await asyncio.start_unix_server(handler,host)
+        finally :
+            os.umask(umask)
+    else :
+        server = await asyncio.start_server(handler,host,port)
+    async with server :
+        await server.serve_forever()
+
+
+# Shell pools: the calls of a ProcessPypeStep(shell_pool=True) are written
+# to long-lived /bin/sh processes instead of each starting its own.  Every
+# call is run as
+#   ( eval '<cmd>' ) </dev/null; printf '\n<marker>%d\n' $?; printf '\n<marker>\n' >&2
+# in a subshell, so cd, exit and variables don't leak into the next call,
+# and its output ends at the markers on stdout and stderr, the one on
+# stdout carrying its exit status.
+
+class ShellCall :
+    """Handle on a call running in a ShellPool's shell, terminate() kills
+    the shell along with it"""
+
+    def __init__(self,proc) :
+        self.proc = proc
+
+    def terminate(self) :
+        try :
+            os.killpg(self.proc.pid,signal.SIGTERM)
+        except OSError :
+            pass
+
+
+class ShellPool :
+    """*size* long-lived shells, started with environment *env* like any
+    ProcessPypeStep call, each running one command at a time"""
+
+    def __init__(self,size=1,env=None,shell='/bin/sh') :
+        self.size = size
+        self.env = env
+        self.shell = shell
+        self.idle = []
+        self.available = None
+
+    async def _start(self) :
+        # own session, so terminating a call takes its children along
+        proc = await asyncio.create_subprocess_exec(self.shell,stdin=PIPE,stdout=PIPE,stderr=PIPE,
+                                                    env=self.env,start_new_session=True)
+        proc.marker = ('__pypeline_%s_'%base64.b32encode(os.urandom(10)).decode('ascii')).encode('ascii')
+        return proc
+
+    @staticmethod
+    async def _read_to_marker(reader,marker,outs) :
+        """Pass what *reader* yields up to *marker* on to the writers in
+        *outs*, return the rest of the marker's line"""
+        marker = b'\n'+marker
+        buf = b''
+        while True :
+            k = buf.find(marker)
+            if k >= 0 :
+                end = buf.find(b'\n',k+len(marker))
+                if end >= 0 :
+                    break
+            data = await reader.read(1<<16)
+            if not data :
+                raise EOFError
+            buf += data
+            # keep what could be the start of the marker
+            if buf.find(marker) < 0 and len(buf) > len(marker) :
+                head, buf = buf[:-len(marker)], buf[-len(marker):]
+                for w in outs :
+                    w.write(head)
+        if k :
+            for w in outs :
+                w.write(buf[:k])
+        return buf[k+len(marker):end]
+
+    async def spawn(self,cmd,outs) :
+        """Start *cmd* in an idle shell and return a ShellCall along with a
+        coroutine that forwards its output to the (stdout, stderr) writer
+        lists *outs* and returns its exit code and stats, like
+        wait_rusage_async()"""
+        if self.available is None :
+            self.available = asyncio.Semaphore(self.size)
+        await self.available.acquire()
+        try :
+            proc = self.idle.pop() if self.idle else await self._start()
+        except BaseException :
+            self.available.release()
+            raise
+        cmd = command_str(cmd)
+        st = time.time()
+        marker = proc.marker.decode('ascii')
+        proc.stdin.write(("( eval %s\n) </dev/null; printf '\\n%s%%d\\n' $?; "
+                          "printf '\\n%s\\n' >&2\n"%(shlex.quote(cmd),marker,marker)).encode('utf-8'))
+
+        async def wait() :
+            alive = False
+            try :
+                status, _ = await asyncio.gather(self._read_to_marker(proc.stdout,proc.marker,outs[0]),
+                                                 self._read_to_marker(proc.stderr,proc.marker,outs[1]))
+                r, alive = int(status), True
+            except (EOFError,ValueError,OSError) : # the shell died, e.g. terminated
+                await self._kill(proc)
+                r = proc.returncode or 1
+            finally :
+                for ws in outs :
+                    for w in ws :
+                        w.eof()
+                if alive :
+                    self.idle.append(proc)
+                else :
+                    await self._kill(proc)
+                self.available.release()
+            return r, {'cmd':cmd,'returncode':r,'start':st,'wall':time.time()-st,'rusage':None}
+        return ShellCall(proc), wait()
+
+    @staticmethod
+    async def _kill(proc) :
+        if proc.returncode is None :
+            try :
+                os.killpg(proc.pid,signal.SIGKILL)
+            except OSError :
+                pass
+        await proc.wait()
+
+    async def close(self) :
+        """Stop the idle shells"""
+        idle, self.idle = self.idle, []
+        for proc in idle :
+            proc.stdin.close()
+        for proc in idle :
+            try :
+                await asyncio.wait_for(proc.wait(),5)
+            except asyncio.TimeoutError :
+                await self._kill(proc)
+
+
+# Status endpoint: while a pipeline with a status_address runs, it serves
+# its progress over HTTP, Pypeline.status() as JSON on /status and the same
+# as Prometheus metrics on /metrics.
+
+def _prometheus_label(v) :
+    return str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def prometheus_metrics(status) :
+    """Render *status*, as returned by Pypeline.status(), in the Prometheus
+    text exposition format"""
+    pipeline = 'pipeline="%s"'%_prometheus_label(status['name'])
+    lines = []
+    def metric(name,kind,help,samples) :
+        lines.append('# HELP %s %s'%(name,help))
+        lines.append('# TYPE %s %s'%(name,kind))
+        for labels, v in samples :
+            labels = ','.join([pipeline]+['%s="%s"'%(k,_prometheus_label(l)) for k,l in labels])
+            lines.append('%s{%s} %r'%(name,labels,float(v)))
+
+    metric('pypeline_running','gauge','Whether the pipeline is running',
+           [((),status['state'] == 'running')])
+    metric('pypeline_elapsed_seconds','gauge','Seconds since the run started',
+           [((),status['elapsed'])] if status['elapsed'] is not None else [])
+    metric('pypeline_eta_seconds','gauge','Estimated seconds until the run ends',
+           [((),status['eta'])] if status['eta'] is not None else [])
+    current = status['current_step']
+    metric('pypeline_current_step','gauge','Index of the step started last',
+           [((('name',current['name']),),current['step'])] if current else [])
+    metric('pypeline_steps','gauge','Number of steps in each state',
+           [((('state',k),),v) for k,v in sorted(status['steps_by_state'].items())])
+    started = [d for d in status['steps'] if 'elapsed' in d]
+    metric('pypeline_step_state','gauge','State of each step started in this run',
+           [((('step',d['step']),('name',d['name']),('state',d['state'])),1) for d in started])
+    metric('pypeline_step_elapsed_seconds','gauge','Seconds each step has been running or ran for',
+           [((('step',d['step']),('name',d['name'])),d['elapsed']) for d in started])
+    metric('pypeline_step_output_bytes_total','counter','Bytes of output captured from each step',
+           [((('step',d['step']),('name',d['name']),('stream',stream)),d[stream+'_bytes'])
+            for d in started for stream in ('stdout','stderr') if stream+'_bytes' in d])
+    return '\n'.join(lines)+'\n'
+
+
+class StatusServer :
+    """Serves the progress of *pipeline* over HTTP on *address*, a
+    'host:port' string (port 0 picks a free port) or unix socket path"""
+
+    def __init__(self,pipeline,address) :
+        self.pipeline = pipeline
+        self.address = address
+        self.server = None
+
+    async def start(self) :
+        host, port = _parse_address(self.address)
+        if port is None :
+            self.server = await asyncio.start_unix_server(self._handle,host)
+        else :
+            self.server = await asyncio.start_server(self._handle,host,port)
+            self.address = '%s:%d'%(host,self.server.sockets[0].getsockname()[1])
+        return self.address
+
+    async def close(self) :
+        if self.server is None :
+            return
+        self.server.close()
+        await self.server.wait_closed()
+        self.server = None
+        host, port = _parse_address(self.address)
+        if port is None :
+            try :
+                os.remove(host)
+            except OSError :
+                pass
+
+    def _response(self,method,path) :
+        path = path.split('?',1)[0]
+        if method not in ('GET','HEAD') :
+            return '405 Method Not Allowed', 'text/plain', b'method not allowed\n'
+        if path in ('/','/status') :
+            body = json.dumps(self.pipeline.status(),indent=1,default=repr)+'\n'
+            return '200 OK', 'application/json', body.encode('utf-8')
+        if path == '/metrics' :
+            body = prometheus_metrics(self.pipeline.status())
+            return '200 OK', 'text/plain; version=0.0.4', body.encode('utf-8')
+        return '404 Not Found', 'text/plain', b'not found\n'
+
+    async def _handle(self,reader,writer) :
+        try :
+            request = await asyncio.wait_for(reader.readline(),10)
+            while True : # headers are ignored
+                line = await asyncio.wait_for(reader.readline(),10)
+                if line in (b'\r\n',b'\n',b'') :
+                    break
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 :
+                return
+            status, ctype, body = self._response(parts[0],parts[1])
+            writer.write(('HTTP/1.0 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                          'Connection: close\r\n\r\n'%(status,ctype,len(body))).encode('latin-1'))
+            if parts[0] != 'HEAD' :
+                writer.write(body)
+            await writer.drain()
+        except (OSError,asyncio.TimeoutError,asyncio.LimitOverrunError,ValueError) :
+            pass
+        finally :
+            writer.close()
+
+
+def _read_procs() :
+    """Return {pid: (ppid, start time, cpu ticks, rss pages)} of all the
+    processes in /proc"""
+    procs = {}
+    for name in os.listdir('/proc') :
+        if not name.isdigit() :
+            continue
+        try :
+            with open('/proc/%s/stat'%name,'rb') as f :
+                stat = f.read()
+        except OSError : # exited
+            continue
+        # the command name in parentheses may contain spaces
+        fields = stat[stat.rfind(b')')+2:].split()
+        procs[int(name)] = (int(fields[1]),int(fields[19]),
+                            int(fields[11])+int(fields[12]),int(fields[21]))
+    return procs
+
+
+class ProcessSampler(threading.Thread) :
+    """Thread sampling, every *interval* seconds, the CPU use and resident
+    memory of the process trees rooted at the pids added with add(), from
+    /proc.  samples is a list of (time, {label: (cpu %, rss bytes)}), the
+    trees of pids added with the same label are added up."""
+
+    page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os,'sysconf') else 4096
+    clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os,'sysconf') else 100
+
+    def __init__(self,interval=0.5) :
+        threading.Thread.__init__(self,name='pypeline-sampler',daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.lock = threading.Lock()
+        self.roots = {}
+        self.done = threading.Event()
+        self._ticks = {}
+        self._last = time.time()
+
+    @staticmethod
+    def available() :
+        return os.path.isfile('/proc/self/stat')
+
+    def add(self,pid,label) :
+        with self.lock :
+            self.roots[pid] = label
+
+    def remove(self,pid) :
+        with self.lock :
+            self.roots.pop(pid,None)
+
+    def run(self) :
+        self._ticks = dict(((pid,p[1]),p[2]) for pid,p in _read_procs().items())
+        self._last = time.time()
+        while not self.done.wait(self.interval) :
+            self.sample()
+
+    def stop(self) :
+        self.done.set()
+        self.join()
+
+    def sample(self) :
+        procs = _read_procs()
+        now = time.time()
+        dt = max(now-self._last,1e-6)
+        children = {}
+        for pid, p in procs.items() :
+            children.setdefault(p[0],[]).append(pid)
+        ticks = dict(((pid,p[1]),p[2]) for pid,p in procs.items())
+        with self.lock :
+            roots = list(self.roots.items())
+        values = {}
+        for root, label in roots :
+            cpu, rss = values.get(label,(0.,0))
+            stack = [root]
+            while stack :
+                pid = stack.pop()
+                p = procs.get(pid)
+                if p is None :
+                    continue
+                # processes started since the last sample count all their ticks
+                cpu += (p[2]-self._ticks.get((pid,p[1]),0))*100./(self.clock_ticks*dt)
+                rss += p[3]*self.page_size
+                stack.extend(children.get(pid,()))
+            values[label] = (cpu,rss)
+        self._ticks, self._last = ticks, now
+        self.samples.append((now,values))
+
+
+def chrome_trace(name,steps,samples,start=0.) :
+    """Return a Chrome trace-event / Perfetto dict of the spans of *steps*
+    run and ProcessSampler *samples* of their processes, as counters.
+    Overlapping steps are laid out on separate lanes.  Times are relative
+    to *start*."""
+    pid = os.getpid()
+    us = lambda t: (t-start)*1e6
+    events = [{'name':'process_name','ph':'M','pid':pid,'tid':0,'args':{'name':name}}]
+    lane_ends = []
+    spans = sorted((s.stats['start'],s.stats['end'],i) for i,s in enumerate(steps)
+                   if s is not None and 'start' in s.stats and 'end' in s.stats)
+    for st, end, i in spans :
+        lane = next((k for k,e in enumerate(lane_ends) if e <= st),len(lane_ends))
+        if lane == len(lane_ends) :
+            lane_ends.append(end)
+            events.append({'name':'thread_name','ph':'M','pid':pid,'tid':lane+1,
+                           'args':{'name':'lane %d'%lane}})
+        lane_ends[lane] = end
+        s = steps[i]
+        events.append({'name':s.name,'cat':s.__class__.__name__,'ph':'X','pid':pid,'tid':lane+1,
+                       'ts':us(st),'dur':(end-st)*1e6,
+                       'args':{'step':i,'status':s.stats.get('status'),
+                               'calls':len(s.stats.get('calls',()))}})
+    # a series stays at its last value until set again, so steps that
+    # stopped running are set to 0
+    series = set()
+    for t, values in samples :
+        labels = dict(('%s %s'%(i,steps[i].name),v) for i,v in values.items()
+                      if i < len(steps) and steps[i] is not None)
+        for gone in series-set(labels) :
+            labels[gone] = (0.,0)
+        series = set(k for k in labels if labels[k] != (0.,0))
+        events.append({'name':'CPU %','ph':'C','pid':pid,'ts':us(t),
+                       'args':dict((k,round(v[0],1)) for k,v in labels.items())})
+        events.append({'name':'RSS MB','ph':'C','pid':pid,'ts':us(t),
+                       'args':dict((k,round(v[1]/float(1<<20),2)) for k,v in labels.items())})
+    return {'traceEvents':events,'displayTimeUnit':'ms',
+            'otherData':{'pipeline':name,'start':start}}
+
+
+def file_stamp(path,hash_contents=False) :
+    """Return a JSON-able stamp identifying the current state of file *path*,
+    its mtime and size, or the sha1 of its contents if *hash_contents* is
+    True.  Returns None if the file does not exist."""
+    try :
+        st = os.stat(path)
+    except OSError :
+        return None
+    if not hash_contents :
+        return [st.st_mtime,st.st_size]
+    h = hashlib.sha1()
+    with open(path,'rb') as f :
+        for chunk in iter(lambda: f.read(1<<20),b'') :
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FingerprintStore :
+    """Persistent record of the fingerprints of successfully executed steps,
+    stored as JSON in *path*.  A fingerprint combines what a step runs (see
+    PypeStep.fingerprint_data) with stamps of its declared input files."""
+
+    def __init__(self,path,hash_inputs=False) :
+        self.path = path
+        self.hash_inputs = hash_inputs
+        self.lock = threading.Lock()
+        self._records = None
+
+    @property
+    def records(self) :
+        if self._records is None :
+            try :
+                with open(self.path) as f :
+                    self._records = json.load(f)
+            except (IOError,OSError,ValueError) :
+                self._records = {}
+        return self._records
+
+    def fingerprint(self,step) :
+        data = {'step':step.fingerprint_data(),
+                'inputs':[(fn,file_stamp(fn,self.hash_inputs)) for fn in step.inputs]}
+        data_str = json.dumps(data,sort_keys=True,default=repr)
+        return hashlib.sha1(data_str.encode('utf-8')).hexdigest()
+
+    def is_up_to_date(self,step) :
+        """True if *step* declares outputs that all exist, are not older than
+        any of its inputs, and were produced by a run with the same
+        fingerprint as the step has now."""
+        if not step.outputs :
+            return False
+        in_stamps = [file_stamp(fn) for fn in step.inputs]
+        out_stamps = [file_stamp(fn) for fn in step.outputs]
+        if None in in_stamps or None in out_stamps :
+            return False
+        # with content hashes, touching an input does not invalidate outputs
+        if not self.hash_inputs and in_stamps and \
+           min(s[0] for s in out_stamps) < max(s[0] for s in in_stamps) :
+            return False
+        with self.lock :
+            rec = self.records.get(step.name)
+        return rec is not None and rec == self.fingerprint(step)
+
+    def record(self,step) :
+        fp = self.fingerprint(step)
+        with self.lock :
+            self.records[step.name] = fp
+            self._save()
+
+    def forget(self,step) :
+        with self.lock :
+            if self.records.pop(step.name,None) is not None :
+                self._save()
+
+    def _save(self) :
+        tmp_path = '%s.tmp%d'%(self.path,os.getpid())
+        with open(tmp_path,'w') as f :
+            json.dump(self.records,f,indent=1,sort_keys=True)
+        os.rename(tmp_path,self.path)
+
+
+class DurationHistory :
+    """Persistent record of how long steps took in earlier runs, stored as
+    JSON in *path*.  Records are keyed by step name and a hash of what the
+    step runs (see PypeStep.fingerprint_data), so changing a step's command
+    starts its history afresh.  The prediction for a step is a moving
+    average of its wall times, the last run weighing *alpha*."""
+
+    def __init__(self,path,alpha=0.5) :
+        self.path = path
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self._records = None
+
+    @property
+    def records(self) :
+        if self._records is None :
+            try :
+                with open(self.path) as f :
+                    self._records = json.load(f)
+            except (IOError,OSError,ValueError) :
+                self._records = {}
+        return self._records
+
+    def key(self,step) :
+        data_str = json.dumps(step.fingerprint_data(),sort_keys=True,default=repr)
+        return '%s %s'%(step.name,hashlib.sha1(data_str.encode('utf-8')).hexdigest()[:16])
+
+    def predict(self,step,key=None) :
+        """Predicted seconds *step* takes, None if it never ran"""
+        key = key or self.key(step)
+        with self.lock :
+            rec = self.records.get(key)
+        return rec['mean'] if rec is not None else None
+
+    def record(self,step,wall,key=None) :
+        key = key or self.key(step)
+        with self.lock :
+            rec = self.records.get(key)
+            if rec is None :
+                rec = self.records[key] = {'mean':wall,'runs':0}
+            rec['mean'] += self.alpha*(wall-rec['mean'])
+            rec['runs'] += 1
+            rec['last'] = wall
+
+    def save(self) :
+        with self.lock :
+            tmp_path = '%s.tmp%d'%(self.path,os.getpid())
+            with open(tmp_path,'w') as f :
+                # json.dumps() without indent uses the C encoder, dump() doesn't
+                f.write(json.dumps(self.records,sort_keys=True,separators=(',',':')))
+            os.rename(tmp_path,self.path)
+
+
+def _critical_paths(durations,depends,dependents) :
+    """Return, for each step, the length of the longest chain of
+    *durations* from it through the steps that depend on it"""
+    n_waiting = [len(d) for d in depends]
+    order = [i for i in range(len(durations)) if n_waiting[i] == 0]
+    for i in order : # grows into a topological order
+        for j in dependents[i] :
+            n_waiting[j] -= 1
+            if n_waiting[j] == 0 :
+                order.append(j)
+    cp = list(durations)
+    for i in reversed(order) :
+        if dependents[i] :
+            cp[i] = durations[i]+max(cp[j] for j in dependents[i])
+    return cp
+
+
+def _canonical(v) :
+    """JSON-able form of *v* for hashing that does not depend on the order
+    of dicts and sets"""
+    if v is None or isinstance(v,(bool,int,float,str)) :
+        return v
+    if isinstance(v,bytes) :
+        return ['bytes',hashlib.sha1(v).hexdigest()]
+    if isinstance(v,(list,tuple)) :
+        return [type(v).__name__,[_canonical(x) for x in v]]
+    if isinstance(v,dict) :
+        return ['dict',sorted([json.dumps(_canonical(k),sort_keys=True),_canonical(x)]
+                              for k,x in v.items())]
+    if isinstance(v,(set,frozenset)) :
+        return [type(v).__name__,sorted(json.dumps(_canonical(x),sort_keys=True) for x in v)]
+    try :
+        return ['pickle',hashlib.sha1(pickle.dumps(v,protocol=4)).hexdigest()]
+    except Exception :
+        return ['repr',repr(v)]
+
+def _callable_identity(fn) :
+    """Name and hash of the source (or byte code) of the callable *fn*"""
+    if isinstance(fn,functools.partial) :
+        return [_callable_identity(fn.func),_canonical(fn.args),_canonical(fn.keywords)]
+    fn = getattr(fn,'__func__',fn) # bound method
+    try :
+        src = inspect.getsource(fn)
+    except (OSError,TypeError) :
+        code = getattr(fn,'__code__',None)
+        src = repr((code.co_code,code.co_consts)) if code else repr(fn)
+    return ['%s.%s'%(getattr(fn,'__module__',None),getattr(fn,'__qualname__',repr(fn))),
+            hashlib.sha1(src.encode('utf-8')).hexdigest()]
+
+def _captured_values(fn) :
+    """_canonical() form of the values the callable *fn* captured, which its
+    result depends on as much as its source: the defaults of its arguments
+    and the contents of its closure cells"""
+    if isinstance(fn,functools.partial) :
+        return _captured_values(fn.func)
+    fn = getattr(fn,'__func__',fn) # bound method
+    cells = []
+    for cell in getattr(fn,'__closure__',None) or () :
+        try :
+            cells.append(cell.cell_contents)
+        except ValueError : # not assigned yet
+            cells.append(None)
+    return _canonical([getattr(fn,'__defaults__',None),getattr(fn,'__kwdefaults__',None),cells])
+
+
+class ResultCache :
+    """On-disk cache of the results of pure PythonPypeSteps in directory
+    *path*, see PythonPypeStep(cache=True).  A result is keyed by a hash of
+    the source of the callable, the defaults and closure values it captured
+    and its arguments, and stored as a pickle
+    file named after the key.  Reading a result touches its file, and when
+    the files add up to more than *max_bytes* the least recently used ones
+    are removed."""
+
+    def __init__(self,path='.pypeline_cache',max_bytes=1<<30) :
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._size = None
+
+    def key(self,fn,args=(),kwargs={}) :
+        data = [_callable_identity(fn),_captured_values(fn),
+                _canonical(tuple(args)),_canonical(dict(kwargs))]
+        return hashlib.sha256(json.dumps(data,sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self,key) :
+        return os.path.join(self.path,key[:2],key+'.pickle')
+
+    def get(self,key) :
+        """Return (True, result) if *key* is in the cache, else (False, None)"""
+        path = self._path(key)
+        try :
+            with open(path,'rb') as f :
+                r = pickle.load(f)
+        except (IOError,OSError) :
+            return False, None
+        except Exception : # truncated, or its classes are gone
+            self.remove(key)
+            return False, None
+        try :
+            os.utime(path)
+        except OSError :
+            pass
+        return True, r
+
+    def put(self,key,r) :
+        """Store result *r* under *key*, returns False if it can't be
+        pickled or is larger than the whole cache"""
+        try :
+            data = pickle.dumps(r,protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception :
+            return False
+        if len(data) > self.max_bytes :
+            return False
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        tmp_path = '%s.tmp%d.%d'%(path,os.getpid(),threading.get_ident())
+        with open(tmp_path,'wb') as f :
+            f.write(data)
+        with self.lock :
+            if self._size is None :
+                self._size = sum(size for _, _, size in self._entries())
+            try :
+                self._size -= os.path.getsize(path)
+            except OSError :
+                pass
+            os.replace(tmp_path,path)
+            self._size += len(data)
+            if self._size > self.max_bytes :
+                self._evict()
+        return True
+
+    def remove(self,key) :
+        try :
+            os.remove(self._path(key))
+        except OSError :
+            pass
+        self._size = None
+
+    def _entries(self) :
+        """(last used, path, size) of every cached result"""
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path) :
+            for fn in filenames :
+                if not fn.endswith('.pickle') :
+                    continue
+                path = os.path.join(dirpath,fn)
+                try :
+                    st = os.stat(path)
+                except OSError :
+                    continue
+                entries.append((st.st_mtime,path,st.st_size))
+        return entries
+
+    def _evict(self) :
+        entries = sorted(self._entries())
+        size = sum(e[2] for e in entries)
+        for mtime, path, nbytes in entries :
+            if size <= self.max_bytes :
+                break
+            try :
+                os.remove(path)
+                size -= nbytes
+            except OSError :
+                pass
+        self._size = size
+
+
+class Journal :
+    """Append-only, fsync'd record of pipeline runs in *path*, one JSON
+    object per line.  Each run writes a 'run' event, then 'start' and 'end'
+    events for each step, the latter with the step's status and result, so
+    an interrupted run can be resumed (see Pypeline.run(resume=True))."""
+
+    # steps that ended with these are not run again when resuming, steps
+    # skipped since they weren't selected are run if selected then
+    complete_statuses = ('done','up to date','restored')
+
+    def __init__(self,path,fsync=True) :
+        self.path = path
+        self.fsync = fsync
+        self._f = None
+
+    def append(self,event,sync=True) :
+        if self._f is None :
+            self._f = open(self.path,'a')
+        event.setdefault('time',time.time())
+        self._f.write(json.dumps(event,default=repr)+'\n')
+        self._f.flush()
+        if self.fsync and sync :
+            os.fsync(self._f.fileno())
+
+    def close(self) :
+        if self._f is not None :
+            self._f.close()
+            self._f = None
+
+    def start_run(self,n_steps,resume=False) :
+        self.append({'event':'run','steps':n_steps,'resume':resume})
+
+    def start_step(self,i,s) :
+        self.append({'event':'start','step':i,'name':s.name})
+
+    def end_step(self,i,s,r) :
+        event = {'event':'end','step':i,'name':s.name,'status':s.stats.get('status')}
+        self.append(self._add_result(event,r))
+
+    def end_shard(self,i,s,k,status,r) :
+        """Record the end of shard *k* of the MapPypeStep *s*, not fsync'd
+        since there may be many of them"""
+        event = {'event':'shard','step':i,'name':s.name,'shard':k,'status':status}
+        self.append(self._add_result(event,r),sync=False)
+
+    @staticmethod
+    def _add_result(event,r) :
+        try :
+            # results that don't survive JSON unchanged (tuples, int keys) are pickled
+            if json.loads(json.dumps(r)) != r :
+                raise TypeError
+            event['result'] = r
+        except (TypeError,ValueError) :
+            try :
+                event['result_pickle'] = base64.b64encode(pickle.dumps(r)).decode('ascii')
+            except Exception :
+                event['result_repr'] = repr(r) # can't be restored
+        return event
+
+    @staticmethod
+    def _get_result(event) :
+        """Return (True, result) for an event with a restorable result,
+        (False, None) otherwise"""
+        if 'result' in event :
+            return True, event['result']
+        if 'result_pickle' in event :
+            try :
+                return True, pickle.loads(base64.b64decode(event['result_pickle']))
+            except Exception :
+                pass
+        return False, None
+
+    def events(self) :
+        """Return the events recorded since the last run that was not a
+        resumed run, ignoring a line left incomplete by a crash"""
+        events = []
+        try :
+            with open(self.path) as f :
+                for line in f :
+                    try :
+                        event = json.loads(line)
+                    except ValueError :
+                        continue
+                    if event.get('event') == 'run' and not event.get('resume') :
+                        events = []
+                    events.append(event)
+        except (IOError,OSError) :
+            pass
+        return events
+
+    def completed_steps(self) :
+        """Return a dict of step index to (step name, restored result) for
+        the steps that completed in the runs since the last fresh run"""
+        completed = {}
+        for event in self.events() :
+            if event.get('event') != 'end' :
+                continue
+            ok, r = self._get_result(event)
+            if ok and event.get('status') in self.complete_statuses :
+                completed[event['step']] = (event.get('name'),r)
+            else :
+                completed.pop(event['step'],None)
+        return completed
+
+    def completed(self,steps) :
+        """Return a dict of step index to restored result for the *steps*
+        that completed in the runs since the last fresh run"""
+        # steps whose name changed since are run again
+        return dict((i,r) for i,(name,r) in self.completed_steps().items()
+                    if i < len(steps) and steps[i].name == name)
+
+    def completed_shards(self,steps) :
+        """Return a dict of step index to a dict of shard index to restored
+        result, for the shards of MapPypeSteps in *steps* that completed in
+        the runs since the last fresh run"""
+        completed = {}
+        for event in self.events() :
+            if event.get('event') != 'shard' :
+                continue
+            i = event['step']
+            if i >= len(steps) or steps[i].name != event.get('name') :
+                continue
+            shards = completed.setdefault(i,{})
+            ok, r = self._get_result(event)
+            if ok and event.get('status') == 'done' :
+                shards[event['shard']] = r
+            else :
+                shards.pop(event['shard'],None)
+        return completed
+
+
+def parse_memory(memory) :
+    """Return *memory* in bytes, given as a number of bytes or a string with
+    a K, M, G or T suffix (powers of 1024), e.g. '64G'"""
+    if memory is None or isinstance(memory,(int,float)) :
+        return memory
+    m = re.match(r'^\s*([\d.]+)\s*([KMGT]?)i?B?\s*$',memory,re.I)
+    if m is None :
+        raise PypelineException('Invalid memory size: %r'%memory)
+    return int(float(m.group(1))*1024**' KMGT'.index(m.group(2).upper() or ' '))
+
+def total_memory() :
+    """Physical memory of the machine in bytes, None if unknown"""
+    try :
+        return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError,ValueError,OSError) :
+        return None
+
+
+class ResourceBudget :
+    """CPUs and memory the steps of a pipeline may use at once, by default
+    all of the machine's.  A step is only started once the cpus and memory
+    it declares (see PypeStep) are free.  A step declaring more than the
+    whole budget is given the whole budget."""
+
+    def __init__(self,cpus=None,memory=None) :
+        self.cpus = cpus or os.cpu_count() or 1
+        self.memory = parse_memory(memory) if memory is not None else total_memory()
+        self.free_cpus = self.cpus
+        self.free_memory = self.memory
+
+    def request(self,step) :
+        """Return the (cpus, memory) *step* needs from this budget"""
+        cpus = min(step.cpus,self.cpus)
+        memory = step.memory or 0
+        if self.memory is not None :
+            memory = min(memory,self.memory)
+        return cpus, memory
+
+    def acquire(self,step) :
+        """Reserve the resources of *step* and return them, or return None
+        if they are not free"""
+        claims = self.acquire_group([step])
+        return claims[0] if claims is not None else None
+
+    def acquire_group(self,steps) :
+        """Reserve the resources of *steps*, which run together (e.g.
+        connected by pipes), and return the list of their claims, or None
+        if they are not all free.  Like a single step, steps declaring more
+        than the whole budget between them are given the whole budget."""
+        claims, cpus_left, memory_left = [], self.cpus, self.memory
+        for step in steps :
+            cpus, memory = self.request(step)
+            cpus = min(cpus,cpus_left)
+            cpus_left -= cpus
+            if self.memory is not None :
+                memory = min(memory,memory_left)
+                memory_left -= memory
+            claims.append((cpus,memory))
+        cpus, memory = sum(c[0] for c in claims), sum(c[1] for c in claims)
+        if cpus > self.free_cpus :
+            return None
+        if self.memory is not None and memory > self.free_memory :
+            return None
+        self.free_cpus -= cpus
+        if self.memory is not None :
+            self.free_memory -= memory
+        return claims
+
+    def release(self,claim) :
+        cpus, memory = claim
+        self.free_cpus += cpus
+        if self.memory is not None :
+            self.free_memory += memory
+
+
+class PypelineHook :
+    """Base class of the hooks a Pypeline calls around each step it runs,
+    see Pypeline.add_hook().  Override the methods needed; an exception
+    raised by one is logged as a warning and otherwise ignored.  Hooks are
+    called in the pipeline's event loop and should return quickly."""
+
+    def step_start(self,pipeline,i,step) :
+        """Step *i* is about to be executed"""
+
+    def step_end(self,pipeline,i,step,result) :
+        """Step *i* was executed and returned *result*, None if it raised"""
+
+    def step_skip(self,pipeline,i,step) :
+        """Step *i* is not selected, or its outputs are up to date"""
+
+    def step_failure(self,pipeline,i,step,exc) :
+        """Step *i* returned False, or raised *exc*.  Called before
+        step_end()."""
+
+    def wrap_callable(self,pipeline,i,step,fn) :
+        """Return the callable PythonPypeStep *step* calls instead of *fn*,
+        for hooks that must run in the thread or process the step's
+        callable runs in.  For executor='process' steps it must be
+        picklable.  Not called for coroutine functions."""
+        return fn
+
+
+def _step_file(directory,i,step,ext) :
+    name = re.sub(r'[^\w.-]+','_',step.name)[:64]
+    return os.path.join(directory,'%d-%s.%s'%(i,name,ext))
+
+def _profiled_call(fn,path,*args,**kwargs) :
+    prof = cProfile.Profile()
+    try :
+        prof.enable()
+    except ValueError : # another profiler is active in this process
+        return fn(*args,**kwargs)
+    try :
+        return fn(*args,**kwargs)
+    finally :
+        prof.disable()
+        prof.dump_stats(path)
+
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+def _traced_call(fn,path,nframes,*args,**kwargs) :
+    global _tracemalloc_users
+    with _tracemalloc_lock :
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing() :
+            tracemalloc.start(nframes)
+        _tracemalloc_users += 1
+    try :
+        return fn(*args,**kwargs)
+    finally :
+        snapshot = tracemalloc.take_snapshot()
+        with _tracemalloc_lock :
+            _tracemalloc_users -= 1
+            if _tracemalloc_users == 0 :
+                tracemalloc.stop()
+        snapshot.dump(path)
+
+
+class _ProfileFileHook(PypelineHook) :
+    """Hook wrapping the callables of PythonPypeSteps in a profiler that
+    writes one file per step to *directory*, recorded in step.stats[key]"""
+
+    ext = key = None
+    # function called with the callable, the file path, _call_args and the
+    # callable's arguments, running the callable and writing the file
+    _call = None
+    _call_args = ()
+
+    def __init__(self,directory='pypeline_profiles') :
+        self.directory = directory
+
+    def wrap_callable(self,pipeline,i,step,fn) :
+        if not os.path.isdir(self.directory) :
+            os.makedirs(self.directory,exist_ok=True)
+        path = _step_file(self.directory,i,step,self.ext)
+        try :
+            os.remove(path) # left by an earlier run
+        except OSError :
+            pass
+        return functools.partial(self._call,fn,path,*self._call_args)
+
+    def step_end(self,pipeline,i,step,result) :
+        path = _step_file(self.directory,i,step,self.ext)
+        if isinstance(step,PythonPypeStep) and os.path.exists(path) :
+            step.stats[self.key] = path
+
+
+class ProfileHook(_ProfileFileHook) :
+    """Runs the callable of each PythonPypeStep under cProfile and dumps
+    its stats, for pstats or snakeviz, to <directory>/<step>-<name>.prof.
+    Only one cProfile profiler can be active at a time on python 3.12+,
+    steps running while another is profiled are then not profiled."""
+
+    ext = 'prof'
+    key = 'profile'
+    _call = staticmethod(_profiled_call)
+
+
+class TracemallocHook(_ProfileFileHook) :
+    """Traces the memory allocations of the callable of each PythonPypeStep
+    with tracemalloc and dumps a snapshot of the memory still allocated
+    when it returns, with up to *nframes* frames of traceback, to
+    <directory>/<step>-<name>.tracemalloc (see tracemalloc.Snapshot.load).
+    Tracing is process wide, so steps running at the same time in the
+    pipeline's process see each other's allocations."""
+
+    ext = 'tracemalloc'
+    key = 'tracemalloc'
+    _call = staticmethod(_traced_call)
+
+    def __init__(self,directory='pypeline_profiles',nframes=10) :
+        _ProfileFileHook.__init__(self,directory)
+        self.nframes = nframes
+
+    @property
+    def _call_args(self) :
+        return (self.nframes,)
+
+
+class _RunSlots :
+    """The slots of a PypelineRunner held by one pipeline run: *held* by
+    its running steps, and *granted* to it while it waited, not yet taken"""
+
+    def __init__(self,runner,pipeline,priority=0,weight=1) :
+        self.runner = runner
+        self.pipeline = pipeline
+        self.priority = priority
+        self.weight = weight
+        # when the run was last given a slot, for round robin between equals
+        self.seq = next(runner._seq)
+        self.held = self.granted = self.wanted = 0
+        self._granted_future = None
+
+    def take(self,n) :
+        """Take slots for a group of *n* steps about to start, at most all
+        of the runner's; returns how many, 0 if they aren't free yet"""
+        return self.runner._take(self,min(n,self.runner.max_workers))
+
+    def release(self,n) :
+        if n :
+            self.held -= n
+            self.runner._release(n)
+
+    def settle(self,waiting) :
+        """Keep waiting for the slots asked for if *waiting*, otherwise give
+        back the ones granted and stop asking.  Returns whether the run is
+        waiting for slots."""
+        if not waiting or not self.wanted :
+            self.wanted = 0
+            if self.granted :
+                n, self.granted = self.granted, 0
+                self.runner._release(n)
+        return self.wanted > 0
+
+    def granted_future(self) :
+        """Future set once the runner has granted this run all the slots it
+        is waiting for"""
+        if self._granted_future is None or self._granted_future.done() :
+            self._granted_future = asyncio.get_running_loop().create_future()
+        self._notify()
+        return self._granted_future
+
+    def _notify(self) :
+        if self.wanted and self.granted >= self.wanted and \
+           self._granted_future is not None and not self._granted_future.done() :
+            self._granted_future.set_result(None)
+
+
+class PypelineRunner :
+    """Runs many pipelines at once, in one event loop, with the steps of
+    all of them sharing *max_workers* slots (default: number of cpus).
+    When runs are waiting for a slot, a freed one goes to the run with the
+    highest priority, with policy='priority', and then to the run holding
+    the fewest slots for its weight, so that with policy='fair' (the
+    default) runs share the slots in proportion to their weights.  Each
+    pipeline keeps its own log, output captures, journal and results."""
+
+    policies = ('fair','priority')
+
+    def __init__(self,max_workers=None,policy='fair') :
+        if policy not in self.policies :
+            raise PypelineException('Unknown runner policy %r, use one of %s'%(
+                                    policy,', '.join(self.policies)))
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.policy = policy
+        self.free = self.max_workers
+        self.runs = []
+        self._seq = itertools.count()
+
+    def _rank(self,run) :
+        # share the run would have with one more slot, ties go to the run
+        # served least recently
+        share = (run.held+run.granted+1)/float(run.weight)
+        if self.policy == 'priority' :
+            return (-run.priority,share,run.seq)
+        return (share,run.seq)
+
+    def _take(self,run,n) :
+        need = max(0,n-run.granted)
+        if need and (self.free < need or
+                     any(r.wanted > r.granted and self._rank(r) < self._rank(run)
+                         for r in self.runs if r is not run)) :
+            run.wanted = n
+            self._grant()
+            return 0
+        self.free -= need
+        run.granted -= n-need
+        run.held += n
+        run.wanted = 0
+        if need :
+            run.seq = next(self._seq)
+        return n
+
+    def _release(self,n) :
+        self.free += n
+        self._grant()
+
+    def _grant(self) :
+        """Hand free slots to the waiting runs in policy order, each run
+        getting all the slots it waits for at once.  When the first run
+        doesn't fit, the free slots are kept for it: slots granted in part
+        to several runs could leave none of them able to start."""
+        while self.free :
+            waiting = [r for r in self.runs if r.wanted > r.granted]
+            if not waiting :
+                break
+            run = min(waiting,key=self._rank)
+            need = run.wanted-run.granted
+            if need > self.free :
+                break
+            self.free -= need
+            run.granted += need
+            run.seq = next(self._seq)
+            run._notify()
+
+    async def run_async(self,pipeline,priority=0,weight=1,**run_kwargs) :
+        """Run *pipeline*, see Pypeline.run_async(), with its steps taking
+        the runner's slots, and return its results.  max_workers defaults
+        to the pipeline's own, or the runner's."""
+        if pipeline._runner_slots is not None :
+            raise PypelineException('Pipeline %s is already running'%pipeline.name)
+        run = _RunSlots(self,pipeline,priority,weight)
+        self.runs.append(run)
+        pipeline._runner_slots = run
+        run_kwargs.setdefault('max_workers',pipeline.max_workers or self.max_workers)
+        try :
+            return await pipeline.run_async(**run_kwargs)
+        finally :
+            pipeline._runner_slots = None
+            self.runs.remove(run)
+            run.settle(False)
+
+    def submit(self,pipeline,priority=0,weight=1,**run_kwargs) :
+        """Start running *pipeline* in the running event loop and return the
+        asyncio.Task of run_async()"""
+        return asyncio.ensure_future(self.run_async(pipeline,priority,weight,**run_kwargs))
+
+    def run(self,pipelines,**run_kwargs) :
+        """Run all of *pipelines*, each a Pypeline or a (pipeline, priority,
+        weight) tuple, and return the list of their results, or of the
+        exception a run raised"""
+        async def run_all() :
+            runs = [p if isinstance(p,tuple) else (p,) for p in pipelines]
+            return await asyncio.gather(*[self.run_async(*r,**run_kwargs) for r in runs],
+                                        return_exceptions=True)
+        _check_no_running_loop('PypelineRunner.run()')
+        return asyncio.run(run_all())
+
+    def status(self) :
+        return {'max_workers':self.max_workers,
+                'policy':self.policy,
+                'free':self.free,
+                'runs':[{'name':r.pipeline.name,'priority':r.priority,'weight':r.weight,
+                         'held':r.held,'waiting':bool(r.wanted)} for r in self.runs]}
+
+
 class Pypeline :
-    def __init__(self,name=None,log=None,ignore_failure=False) :
+    def __init__(self,name=None,log=None,ignore_failure=False,max_workers=None,
+                 fingerprints='.pypeline_fingerprints.json',hash_inputs=False,
+                 report=None,capture=True,capture_size=1<<18,capture_dir=None,
+                 journal=None,workers=None,process_workers=None,resources=None,
+                 result_cache='.pypeline_cache',cache_size=1<<30,status_address=None,
+                 hooks=None,history=None,trace=None,trace_interval=0.5,
+                 lookahead=256) :
         self.steps = []
+        # step sources added with add_steps(lazy=True), generated into
+        # self.steps as a run goes and dropped again at its end; at most
+        # lookahead generated steps are left to finish at any time
+        self._lazy_steps = []
+        # ids of the sources that are iterators and were iterated over by a
+        # run, they cannot generate their steps again
+        self._spent_sources = set()
+        self.lookahead = lookahead
         out_fds = [sys.stderr]
         if log :
             out_fds.append(open(log,'a'))
@@ -168,21 +2305,146 @@ class Pypeline :
 
         self.name = 'Pipeline' if name is None else name
         self.ignore_failure = ignore_failure
+        # number of steps run at once, 1 by default, or as many as fit in
+        # the resource budget if one is set
+        self.max_workers = max_workers
+        # ResourceBudget, or dict of its arguments, steps are only started
+        # when the cpus and memory they declare are free.  True budgets the
+        # whole machine.
+        if resources is True :
+            resources = ResourceBudget()
+        elif isinstance(resources,dict) :
+            resources = ResourceBudget(**resources)
+        self.resources = resources
+        # only consulted for steps that declare their outputs
+        self.fingerprints = FingerprintStore(fingerprints,hash_inputs) if fingerprints else None
+        # durations of the steps in earlier runs, ready steps on the longest
+        # predicted path to the end of the pipeline are started first; kept
+        # next to the log by default, False for none
+        if history is None and log :
+            history = log+'.history.json'
+        self.history = DurationHistory(history) if history else None
+        self._history_keys = None
+        # ResultCache, or its directory, of the PythonPypeSteps created with
+        # cache=True, holding at most cache_size bytes of results
+        if result_cache and not isinstance(result_cache,ResultCache) :
+            result_cache = ResultCache(result_cache,cache_size)
+        self.result_cache = result_cache or None
+
+        # JSON resource usage report written at the end of each run, next
+        # to the log by default, False for none
+        if report is None and log :
+            report = log+'.report.json'
+        self.report_path = report or None
+        self.report = None
+        # capture the output of each step in step.stdout and step.stderr,
+        # keeping at most capture_size bytes of each in memory and spilling
+        # the rest to files in capture_dir
+        self.capture = capture
+        self.capture_size = capture_size
+        self.capture_dir = capture_dir or (log+'.steps' if log else None)
+        # checkpoint journal used to resume interrupted runs, a path or True
+        # for one next to the log; it fsyncs twice per step, so it is off
+        # by default
+        if journal is True :
+            journal = log+'.journal' if log else '.pypeline_journal'
+        self.journal = Journal(journal) if journal else None
+        # WorkerPool, or list of worker addresses, to run ProcessPypeStep
+        # commands on instead of locally
+        if workers is not None and not isinstance(workers,WorkerPool) :
+            workers = WorkerPool(workers)
+        self.workers = workers
+        # number of worker processes PythonPypeSteps with executor='process'
+        # run in (default: number of cpus), the pool is started when first
+        # needed and reused by all the steps of a run
+        self.process_workers = process_workers
+        self._process_pool = None
+        # open pipes between streaming steps
+        self._stream_fds = set()
+        # 'host:port' or unix socket path the progress of a run is served on
+        # while it runs, see StatusServer
+        self.status_address = status_address
+        self._run_start = self._run_end = None
+        self._run_workers = 1
+        self._run_selected = None
+        # set by run() and iter_run(), which own the event loop: a sequential
+        # run then calls blocking steps on the calling thread
+        self._own_loop = False
+        self._inline_steps = False
+        # PypelineHooks called around each step
+        self.hooks = list(hooks or [])
+        # Chrome trace-event JSON file written at the end of each run, with
+        # the CPU use and memory of the processes of ProcessPypeSteps
+        # sampled every trace_interval seconds
+        self.trace_path = trace
+        self.trace_interval = trace_interval
+        self._sampler = None
+        # set by PypelineRunner.run_async()
+        self._runner_slots = None
+        # set by aiter_run(), called with (step index, step name, result)
+        # as each step finishes
+        self._on_finish = None
+        self._released = {}
 
         self.curr_step_num = None
         self.curr_step_name = None
+        self.results = []
 
         self.announce(self.name)
 
-    def add_step(self,step,pos=None) :
+    def add_step(self,step,pos=None,depends=None) :
+        if depends is not None :
+            step.depends = depends
+        if self._lazy_steps and pos is None : # after the generated steps
+            self._lazy_steps.append([step])
+            return
         pos = len(self.steps) if pos is None else pos
         step.pipeline = self
         self.steps.insert(pos,step)
 
-    def add_steps(self,steps,pos=None) :
+    def add_steps(self,steps,pos=None,lazy=False) :
+        """Insert all of *steps* at *pos*, the end by default, in one go.
+        With *lazy*, *steps* is an iterable of steps, or a step factory: a
+        callable returning one, called at the start of each run.  It is
+        only iterated over as a run needs more steps, see run_async(), and
+        the steps added at the end after it follow the steps it generates.
+        An iterator, such as a generator, can only be iterated over once:
+        pass a factory or a re-iterable to run the pipeline more than once,
+        running it again raises a PypelineException otherwise."""
+        if lazy or (self._lazy_steps and pos is None) :
+            if pos is not None :
+                raise PypelineException('Lazily generated steps can only be '
+                                        'added at the end of a pipeline')
+            self._lazy_steps.append(steps if lazy else list(steps))
+            return
         pos = len(self.steps) if pos is None else pos
-        for i,s in enumerate(steps) :
-            self.add_step(s,pos=pos+i)
+        steps = list(steps)
+        for s in steps :
+            s.pipeline = self
+        self.steps[pos:pos] = steps
+
+    def _generate_steps(self) :
+        """Yield the steps of the lazy step sources in turn, calling the
+        step factories"""
+        for source in self._lazy_steps :
+            if callable(source) :
+                source = source()
+            elif iter(source) is source :
+                self._spent_sources.add(id(source))
+            for s in source :
+                s.pipeline = self
+                yield s
+
+    def add_hook(self,hook) :
+        """Call the PypelineHook *hook* around each step run from now on"""
+        self.hooks.append(hook)
+
+    def _call_hooks(self,event,*args) :
+        for hook in self.hooks :
+            try :
+                getattr(hook,event)(self,*args)
+            except Exception as e :
+                self.warn('%s hook %s failed: %s\n'%(event,hook.__class__.__name__,e))
 
     def announce(self,st) :
         self._write_output(st,announce)
@@ -208,41 +2470,824 @@ class Pypeline :
                 fn(st,fd=fd)
             else :
                 fd.write(r)
+            # Tee writes to the underlying fds, keep messages in order with it
+            fd.flush()
+
+    def _step_finder(self) :
+        """Return a function that finds the index of a step given as a step
+        object, name or index, or returns None if there is no such step"""
+        by_id, by_name = {}, {}
+        for i,s in enumerate(self.steps) :
+            by_id[id(s)] = i
+            by_name.setdefault(s.name,i)
+        def find(ref) :
+            if isinstance(ref,PypeStep) :
+                return by_id.get(id(ref))
+            elif isinstance(ref,int) :
+                return ref if 0 <= ref < len(self.steps) else None
+            return by_name.get(ref)
+        return find
+
+    def _resolve_depends(self) :
+        """Return a list with the indices of the steps each step depends on.
+        Steps that do not declare their dependencies depend on the step
+        immediately preceding them, as in a plain sequential pipeline."""
+        find = self._step_finder()
+        depends = []
+        for i,s in enumerate(self.steps) :
+            if s.depends is None :
+                depends.append([i-1] if i > 0 else [])
+                continue
+            step_deps = s.depends
+            if not isinstance(step_deps,(list,tuple,set)) :
+                step_deps = [step_deps]
+            d = set()
+            for dep in step_deps :
+                j = find(dep)
+                if j is None :
+                    raise PypelineException('Step %s depends on unknown step %r'%(s.name,dep))
+                if j == i :
+                    raise PypelineException('Step %s depends on itself'%s.name)
+                d.add(j)
+            depends.append(sorted(d))
+        return depends
+
+    @staticmethod
+    def _dependents(depends) :
+        dependents = [[] for _ in depends]
+        for i,d in enumerate(depends) :
+            for j in d :
+                dependents[j].append(i)
+        return dependents
+
+    def _predict_durations(self,selected) :
+        """Return the seconds each step is predicted to take, 0 for the
+        steps not in *selected*, and whether each prediction is from the
+        history.  Steps that never ran are predicted to take the mean of
+        those that did."""
+        n = len(self.steps)
+        if self.history is None :
+            return [0.]*n, [False]*n
+        # keys hash each step's fingerprint data, only worked out once a run
+        self._history_keys = keys = [self.history.key(s) if i in selected else None
+                                     for i,s in enumerate(self.steps)]
+        predicted = [self.history.predict(s,keys[i]) if i in selected else 0.
+                     for i,s in enumerate(self.steps)]
+        known = [p is not None for p in predicted]
+        recorded = [p for i,p in enumerate(predicted) if p is not None and i in selected]
+        mean = sum(recorded)/len(recorded) if recorded else 0.
+        return [mean if p is None else p for p in predicted], known
+
+    def _record_history(self) :
+        if self.history is None :
+            return
+        # keys are only worked out for the steps not generated lazily
+        keys = self._history_keys
+        if keys is None :
+            keys = [None]*len(self.steps)
+        for s,key in zip(self.steps,keys) :
+            if s.stats.get('status') == 'done' and s.stats.get('cache') != 'hit' :
+                self.history.record(s,s.stats['wall'],key)
+        try :
+            self.history.save()
+        except (IOError,OSError) as e :
+            self.warn('Could not write step history %s: %s\n'%(self.history.path,e))
+
+    def plan(self,steplist=None,max_workers=None) :
+        """Predict a run of the steps in *steplist* (all by default) from
+        the step history without executing anything: print when each step
+        would start and end, the makespan and the critical path, and return
+        them as a dict.  Steps are launched in the order run_async() uses,
+        the resource budget is not taken into account."""
+        n = len(self.steps)
+        if steplist is None :
+            steplist = range(n)
+        selected = steplist if isinstance(steplist,StepList) else StepList(steplist)
+        max_workers = max_workers or self.max_workers or (n if self.resources is not None else 1)
+        depends = self._resolve_depends()
+        producers = self._resolve_streams(depends)
+        dependents = self._dependents(depends)
+        consumer = dict((j,i) for i,j in enumerate(producers) if j is not None)
+        durations, known = self._predict_durations(selected)
+        cp = _critical_paths(durations,depends,dependents)
+        prio = [(-s.priority,-cp[i]) for i,s in enumerate(self.steps)]
+
+        n_waiting = [len(d) for d in depends]
+        ready = [(prio[i],i) for i in range(n) if n_waiting[i] == 0 and producers[i] is None]
+        heapq.heapify(ready)
+        running = []
+        start, end = [None]*n, [None]*n
+        t = 0.
+        while ready or running :
+            while ready and len(running) < max_workers :
+                key, i = heapq.heappop(ready)
+                group = [i]
+                while group[-1] in consumer :
+                    group.append(consumer[group[-1]])
+                for j in group :
+                    start[j], end[j] = t, t+durations[j]
+                    heapq.heappush(running,(end[j],j))
+            t, i = heapq.heappop(running)
+            for j in dependents[i] :
+                n_waiting[j] -= 1
+                if n_waiting[j] == 0 :
+                    heapq.heappush(ready,(prio[j],j))
+        makespan = max([e for e in end if e is not None] or [0.])
+
+        path = []
+        roots = [i for i in range(n) if not depends[i] and producers[i] is None]
+        if roots :
+            path.append(max(roots,key=lambda i: (cp[i],-i)))
+            while dependents[path[-1]] :
+                path.append(max(dependents[path[-1]],key=lambda i: (cp[i],-i)))
+
+        self.printout('Plan for %s, up to %d step(s) at once\n'%(self.name,max_workers))
+        for i,s in enumerate(self.steps) :
+            if i not in selected :
+                self.printout('%d: %s SKIPPED\n'%(i,s.name))
+            elif start[i] is None :
+                self.printout('%d: %s never runs, circular dependencies\n'%(i,s.name))
+            else :
+                self.printout('%d: %s %s%s, %s - %s\n'%(i,s.name,'' if known[i] else '~',
+                              format_seconds(durations[i]),format_seconds(start[i]),
+                              format_seconds(end[i])))
+        self.printout('Predicted makespan: %s\n'%format_seconds(makespan))
+        self.printout('Critical path (%s): %s\n'%(format_seconds(cp[path[0]]) if path else '0.0s',
+                                                ' -> '.join(str(i) for i in path)))
+        return {'max_workers':max_workers,
+                'steps':[{'step':i,'name':s.name,'selected':i in selected,
+                          'predicted':durations[i],'from_history':known[i],
+                          'start':start[i],'end':end[i]} for i,s in enumerate(self.steps)],
+                'makespan':makespan,
+                'critical_path':path}
+
+    def _resolve_streams(self,depends) :
+        """Return a list with the index of the step each step reads its
+        stdin from, None for steps that don't.  A step reading another's
+        output starts together with it, so its other dependencies are moved
+        to that step in *depends*."""
+        find = self._step_finder()
+        producers = [None]*len(self.steps)
+        for i,s in enumerate(self.steps) :
+            if s.stdin is None :
+                continue
+            j = find(s.stdin)
+            if j is None :
+                raise PypelineException('Step %s reads from unknown step %r'%(s.name,s.stdin))
+            if j == i or j in producers :
+                raise PypelineException('Step %s cannot read the output of step %s, '
+                                        'it is already piped'%(s.name,self.steps[j].name))
+            producers[i] = j
+        changed = True
+        while changed :
+            changed = False
+            for i,j in enumerate(producers) :
+                if j is None or not depends[i] :
+                    continue
+                d = set(depends[j]).union(depends[i])-set([i,j])
+                depends[i] = []
+                if d != set(depends[j]) :
+                    depends[j] = sorted(d)
+                    changed = True
+        return producers
+
+    def _connect_streams(self,group,producers,selected) :
+        """Create the pipes between the steps in *group*, a step followed by
+        the steps reading its output in turn.  There is no pipe to a step
+        that is not selected, the output of the step before it is logged."""
+        for i in group[1:] :
+            if i not in selected :
+                continue
+            r_fd, w_fd = os.pipe()
+            self.steps[producers[i]]._stream_out = w_fd
+            self.steps[i]._stream_in = r_fd
+            self._stream_fds.update((r_fd,w_fd))
+
+    def _close_streams(self,s) :
+        for fd in (s._stream_in,s._stream_out) :
+            if fd is not None :
+                os.close(fd)
+                self._stream_fds.discard(fd)
+        s._stream_in = s._stream_out = None
+
+    def status(self) :
+        """Return a JSON-able snapshot of the progress of the current, or
+        last, run: the state, elapsed time and captured output of each step
+        and an estimate of the seconds left, from the mean duration of the
+        steps done so far and the number of steps running at once"""
+        now = time.time()
+        start, end = self._run_start, self._run_end
+        selected = self._run_selected
+        # lazily generated steps released as they finished are only counted
+        steps, counts = [], dict(self._released)
+        walls, running, n_pending = [], [], 0
+        for i, s in enumerate(self.steps) :
+            if s is None :
+                continue
+            stats = s.stats
+            state = stats.get('status','pending')
+            counts[state] = counts.get(state,0)+1
+            d = {'step':i,'name':s.name,'state':state}
+            if 'start' in stats :
+                d['elapsed'] = stats.get('wall',now-stats['start'])
+                for stream in ('stdout','stderr') :
+                    out = getattr(s,stream,None)
+                    if out is not None :
+                        d[stream+'_bytes'] = out.nbytes
+                        d[stream+'_rate'] = out.nbytes/d['elapsed'] if d['elapsed'] > 0 else 0.
+                if state == 'running' :
+                    running.append(d['elapsed'])
+                elif state in ('done','failed') :
+                    walls.append(d['elapsed'])
+            elif state == 'pending' and (selected is None or i in selected) :
+                n_pending += 1
+            steps.append(d)
+        eta = None
+        if end is not None :
+            eta = 0.
+        elif start is not None and walls :
+            mean = sum(walls)/len(walls)
+            # a step running past the mean still has some time left
+            left = sum(max(mean-e,.1*mean) for e in running)+n_pending*mean
+            # under a resource budget, or a PypelineRunner's slots, the steps
+            # running now are the best guess of how many can run at once
+            workers = self._run_workers
+            if self.resources is not None or self._runner_slots is not None :
+                workers = len(running)
+            eta = left/max(1,min(workers,len(running)+n_pending))
+        return {'name':self.name,
+                'state':'idle' if start is None else 'running' if end is None else 'finished',
+                'start':start,
+                'elapsed':None if start is None else (end or now)-start,
+                'eta':eta,
+                'current_step':{'step':self.curr_step_num,'name':self.curr_step_name}
+                               if self.curr_step_num is not None else None,
+                'steps_by_state':counts,
+                'steps':steps}
+
+    def _capture_path(self,i,s,stream) :
+        if self.capture_dir is None :
+            self.capture_dir = tempfile.mkdtemp(prefix='pypeline-')
+        name = re.sub(r'[^\w.-]+','_',s.name)[:64]
+        return os.path.join(self.capture_dir,'%d-%s.%s'%(i,name,stream))
+
+    def _new_process_pool(self,max_workers) :
+        ctx = multiprocessing.get_context()
+        fds = ()
+        if ctx.get_start_method() == 'fork' :
+            # forked workers must not hold the Tee pipe, or pipes between
+            # steps, open
+            fds = (self.out_f.fileno(),)+tuple(self._stream_fds)
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,mp_context=ctx,
+                                                      initializer=_close_fds,initargs=(fds,))
+
+    def _get_process_pool(self) :
+        if self._process_pool is None :
+            self._process_pool = self._new_process_pool(self.process_workers or os.cpu_count() or 1)
+        return self._process_pool
+
+    def _shutdown_process_pool(self) :
+        pool, self._process_pool = self._process_pool, None
+        if pool is not None :
+            pool.shutdown(wait=False,cancel_futures=True)
+
+    async def _call_in_process(self,fn,args=(),kwargs={},timeout=None) :
+        """Call *fn* in the process pool and return what _pool_call()
+        returns.  A call with a *timeout* runs in a worker of its own, which
+        is killed after *timeout* seconds, raising asyncio.TimeoutError:
+        killing a worker of the shared pool would break it, failing the
+        calls of other steps running in it.  Calls hit by a broken pool
+        raise BrokenProcessPool, they are not run again."""
+        payload = _dumps_call(fn,args,kwargs)
+        if timeout is None :
+            pool = self._get_process_pool()
+            try :
+                return await asyncio.wrap_future(pool.submit(_pool_call,payload))
+            except concurrent.futures.process.BrokenProcessPool :
+                if self._process_pool is pool :
+                    self._process_pool = None
+                raise
+
+        fd, pid_path = tempfile.mkstemp(prefix='pypeline-pid-')
+        os.close(fd)
+        pool = self._new_process_pool(1)
+        try :
+            fut = pool.submit(_pool_call,payload,pid_path)
+            return await asyncio.wait_for(asyncio.wrap_future(fut),timeout)
+        except (asyncio.TimeoutError,asyncio.CancelledError) :
+            with open(pid_path) as f :
+                pid = f.read()
+            if pid :
+                try :
+                    os.kill(int(pid),signal.SIGKILL)
+                except OSError :
+                    pass
+            raise
+        finally :
+            pool.shutdown(wait=False,cancel_futures=True)
+            os.unlink(pid_path)
+
+    async def _run_step(self,i,s,selected,force) :
+        """Execute or skip a single step and return its result.  Steps whose
+        declared outputs are up to date are skipped unless *force* is
+        True."""
+        s.stats = {'step':i,'name':s.name,'status':'running','start':time.time()}
+        if self.capture :
+            # spill files are only named when output spills to disk
+            s.stdout = StepOutput(functools.partial(self._capture_path,i,s,'stdout'),self.capture_size)
+            s.stderr = StepOutput(functools.partial(self._capture_path,i,s,'stderr'),self.capture_size)
+        try :
+            # a streaming step has no outputs on its own
+            executing = False
+            streaming = s._stream_in is not None or s._stream_out is not None
+            store = self.fingerprints if s.outputs and not streaming else None
+            up_to_date = False
+            if store is not None and not force and i in selected :
+                if store.hash_inputs :
+                    up_to_date = await run_in_thread(store.is_up_to_date,s)
+                else :
+                    up_to_date = store.is_up_to_date(s)
+            if i not in selected :
+                s.stats['status'] = 'skipped'
+                self._call_hooks('step_skip',i,s)
+                r = await s.skip_async()
+            elif up_to_date :
+                s.stats['status'] = 'up to date'
+                self._call_hooks('step_skip',i,s)
+                r = await s.skip_async()
+                s._print_msg('\tOutputs up to date')
+            else :
+                if store is not None :
+                    store.forget(s)
+                self._call_hooks('step_start',i,s)
+                executing = True
+                r = await s.execute_async()
+                executing = False
+                s.stats['status'] = 'failed' if r is False else 'done'
+                if store is not None and r is not False :
+                    store.record(s)
+                if r is False :
+                    self._call_hooks('step_failure',i,s,None)
+                self._call_hooks('step_end',i,s,r)
+        except BaseException as e :
+            s.stats['status'] = 'error'
+            if executing :
+                if isinstance(e,Exception) :
+                    self._call_hooks('step_failure',i,s,e)
+                self._call_hooks('step_end',i,s,None)
+            raise
+        finally :
+            self._close_streams(s)
+            s.stats['end'] = time.time()
+            s.stats['wall'] = s.stats['end']-s.stats['start']
+            s.stats['children'] = sum_rusage(c['rusage'] for c in s.stats.get('calls',[]))
+            for stream in ('stdout','stderr') :
+                out = getattr(s,stream,None)
+                if out is not None :
+                    out.close()
+                    s.stats[stream] = {'bytes':out.nbytes,
+                                       'path':out.path if out.spilled else None}
+        return r
 
-    def run(self,interactive=False,steplist=None) :
-
+    def _write_report(self,start,max_workers) :
+        """Collect the resource usage of each step run into self.report and
+        write it as JSON to self.report_path, if set"""
+        steps = [s.stats for s in self.steps if getattr(s,'stats',None)]
+        end = time.time()
+        self.report = {'name':self.name,
+                       'start':start,
+                       'end':end,
+                       'wall':end-start,
+                       'max_workers':max_workers,
+                       'resources':{'cpus':self.resources.cpus,'memory':self.resources.memory}
+                                   if self.resources is not None else None,
+                       'steps':steps,
+                       'released_steps':sum(self._released.values()),
+                       'children':sum_rusage(s.get('children') for s in steps),
+                       'self':rusage_dict(resource.getrusage(resource.RUSAGE_SELF)) if resource else None}
+        if self.report_path :
+            try :
+                with open(self.report_path,'w') as f :
+                    json.dump(self.report,f,indent=1,default=repr)
+            except (IOError,OSError) as e :
+                self.warn('Could not write pipeline report %s: %s\n'%(self.report_path,e))
+
+    def _write_trace(self,start) :
+        """Stop the process sampler and write the Chrome trace of the run to
+        self.trace_path"""
+        sampler, self._sampler = self._sampler, None
+        if sampler is not None :
+            sampler.stop()
+        trace = chrome_trace(self.name,self.steps,sampler.samples if sampler else [],start)
+        try :
+            with open(self.trace_path,'w') as f :
+                f.write(json.dumps(trace,default=repr))
+        except (IOError,OSError) as e :
+            self.warn('Could not write pipeline trace %s: %s\n'%(self.trace_path,e))
+
+    def run(self,interactive=False,steplist=None,max_workers=None,force=False,resume=False) :
+        """Run the pipeline and return the list of step results, see
+        run_async().  When steps run one at a time (max_workers=1, the
+        default without a resource budget) and no status is served, the
+        execute() of steps that block, such as synchronous PythonPypeStep
+        callables, is called on the calling thread, as before run_async()
+        existed.  Otherwise they run in threads of their own, where e.g.
+        signal.signal() cannot be called.  Cannot be called from a running
+        event loop, await run_async() there instead."""
+        _check_no_running_loop('Pypeline.run()')
+        self._own_loop = True
+        try :
+            return asyncio.run(self.run_async(interactive=interactive,
+                                              steplist=steplist,
+                                              max_workers=max_workers,
+                                              force=force,
+                                              resume=resume))
+        except KeyboardInterrupt :
+            self.printout('\nPipeline interrupted by user, aborting\n')
+            return self.results
+        finally :
+            self._own_loop = False
+
+    def iter_run(self,**run_kwargs) :
+        """Run the pipeline, yielding (step index, step name, result) as
+        each step finishes, see aiter_run().  Steps are called as by
+        run()."""
+        _check_no_running_loop('Pypeline.iter_run()')
+        loop = asyncio.new_event_loop()
+        finished = self.aiter_run(**run_kwargs)
+        self._own_loop = True
+        try :
+            while True :
+                try :
+                    item = loop.run_until_complete(finished.__anext__())
+                except StopAsyncIteration :
+                    return
+                yield item
+        finally :
+            self._own_loop = False
+            try :
+                loop.run_until_complete(finished.aclose())
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally :
+                loop.close()
+
+    async def aiter_run(self,**run_kwargs) :
+        """Run the pipeline with run_async(**run_kwargs), yielding (step
+        index, step name, result) as each step finishes, including the
+        steps skipped or restored.  The results of lazily generated steps
+        are only yielded, not kept in self.results.  Exceptions are raised
+        once the steps finished before are yielded, and leaving the loop
+        early cancels the run."""
+        queue = asyncio.Queue()
+        self._on_finish = queue.put_nowait
+        run = asyncio.ensure_future(self.run_async(**run_kwargs))
+        get = None
+        try :
+            while True :
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait([run,get],return_when=asyncio.FIRST_COMPLETED)
+                if not get.done() :
+                    break
+                yield get.result()
+            while not queue.empty() :
+                yield queue.get_nowait()
+            run.result()
+        finally :
+            if get is not None :
+                get.cancel()
+            if not run.done() :
+                run.cancel()
+                await asyncio.gather(run,return_exceptions=True)
+            self._on_finish = None
+
+    async def run_async(self,interactive=False,steplist=None,max_workers=None,force=False,resume=False) :
+        """Run the steps in *steplist* (all by default, or chosen
+        interactively), skipping the others.  Up to *max_workers* steps run
+        at once, each as soon as the steps it depends on have finished and
+        the cpus and memory it declares fit in the pipeline's resource
+        budget, higher priority steps first.  A step reading another's
+        output (see PypeStep(stdin=...)) starts along with it, whatever
+        *max_workers*.
+        With *resume*, steps the journal records as completed since the
+        last fresh run are not run again and their results are restored.
+        Steps added with add_steps(lazy=True) are generated after the
+        others as the run goes, until self.lookahead (or 2*max_workers) of
+        them are left to finish.  They can only depend on steps before
+        them and not read another's output, get no predicted durations,
+        and are released as they finish: their entries in self.steps are
+        set to None, and they are removed at the end of the run.
+        Returns the list of step results, up to the last step that ran."""
+
+        if resume and self.journal is None :
+            raise PypelineException('Cannot resume pipeline without a journal, '
+                                    'pass journal= to Pypeline')
+        if any(id(source) in self._spent_sources for source in self._lazy_steps) :
+            raise PypelineException('Lazy step source already used up by a previous run, '
+                                    'pass a step factory to add_steps(lazy=True) to run '
+                                    'the pipeline again')
+
+        if self.out_f.closed : # by the end of the last run
+            self.tee_t = Tee(self.tee_t.wlist)
+            self.out_f = self.tee_t.out_w
+            self.tee_t.start()
+
+        self.results = results = []
+        n_static = len(self.steps)
+        steps_iter = self._generate_steps() if self._lazy_steps else None
+        self._released = {}
+        budget = self.resources
+        max_workers = max_workers or self.max_workers
+        if max_workers is None :
+            if budget is None :
+                max_workers = 1
+            else :
+                max_workers = len(self.steps) if steps_iter is None else self.lookahead
+        start, max_workers = time.time(), max(1,max_workers)
+        for s in self.steps :
+            s.stats = {}
+        running, claims = {}, {}
+        # slots of the PypelineRunner this run is part of, if any
+        slots, slotted = self._runner_slots, set()
+        status_server = None
+        self._run_start, self._run_end = start, None
+        self._run_workers, self._run_selected = max_workers, None
+        # nothing else to run meanwhile in a loop of our own
+        self._inline_steps = (self._own_loop and max_workers == 1 and slots is None
+                              and self.status_address is None)
+        self._history_keys = None
         try :
             if interactive :
                 steplist = get_steplist(self)
             else :
-                if steplist is not None :
-                    steplist.sort() # just in case
-                else :
-                    steplist = range(len(self.steps)) # do all steps
-
-            results = []
-            for i,s in enumerate(self.steps) :
-                self.curr_step_num = i
-                self.curr_step_name = s.name
-                if i in steplist :
-                    r = s.execute()
-                else :
-                    r = s.skip()
-                results.append(r)
+                if steplist is None : # do all steps, generated ones too
+                    steplist = range(len(self.steps) if steps_iter is None else sys.maxsize)
+            selected = steplist if isinstance(steplist,StepList) else StepList(steplist)
+            self._run_selected = selected
+            # no need to generate steps after the last one selected
+            stop = selected.ranges()[-1][1] if selected else 0
+            if self.status_address is not None :
+                status_server = StatusServer(self,self.status_address)
+                self.info('Serving status on %s'%await status_server.start())
+            if self.trace_path is not None and ProcessSampler.available() :
+                self._sampler = ProcessSampler(self.trace_interval)
+                self._sampler.start()
+
+            n = len(self.steps)
+            depends = self._resolve_depends()
+            producers = self._resolve_streams(depends)
+            consumer = dict((j,i) for i,j in enumerate(producers) if j is not None)
+            def stream_group(i) :
+                group = [i]
+                while group[-1] in consumer :
+                    group.append(consumer[group[-1]])
+                return group
+            n_waiting = [len(d) for d in depends]
+            dependents = self._dependents(depends)
+
+            restored, journaled = {}, {}
+            for s in self.steps :
+                if isinstance(s,MapPypeStep) : # left by a resume it didn't run in
+                    s.restored_shards = {}
+            if resume :
+                restored = self.journal.completed(self.steps)
+                # steps connected by pipes are only restored together
+                for i in range(n) :
+                    if producers[i] is None and i in consumer :
+                        group = stream_group(i)
+                        if not all(j in restored for j in group) :
+                            for j in group :
+                                restored.pop(j,None)
+                if restored :
+                    self.info('Resuming, %d step(s) already completed'%len(restored))
+                for i, shards in self.journal.completed_shards(self.steps).items() :
+                    if isinstance(self.steps[i],MapPypeStep) and i not in restored :
+                        self.steps[i].restored_shards = shards
+                if steps_iter is not None :
+                    journaled = self.journal.completed_steps()
+            if self.journal is not None :
+                self.journal.start_run(n,resume=resume)
+
+            # ready steps are launched by priority, then longest predicted
+            # path to the end of the pipeline first, then in pipeline order
+            cp = _critical_paths(self._predict_durations(selected)[0],depends,dependents)
+            prio = [(-s.priority,-cp[i]) for i,s in enumerate(self.steps)]
+            # steps reading another's output are started along with it
+            ready = [(prio[i],i) for i in range(n) if n_waiting[i] == 0 and producers[i] is None]
+            heapq.heapify(ready)
+            self.results = results = [None]*n
+            finished = bytearray(n)
+            last_done, n_done = -1, 0
+            failed, exc = False, None
+
+            # generated steps are found by name, or as objects while they
+            # are not released
+            find_static, generated_ids, generated_names = self._step_finder(), {}, {}
+            def find(ref) :
+                j = find_static(ref)
+                if j is not None or isinstance(ref,int) :
+                    return j
+                if isinstance(ref,PypeStep) :
+                    return generated_ids.get(id(ref),generated_names.get(ref.name))
+                return generated_names.get(ref)
+            lookahead = max(self.lookahead,2*max_workers)
+
+            def generate() :
+                nonlocal steps_iter, n
+                while n-n_done < lookahead and n < stop :
+                    s = next(steps_iter,None)
+                    if s is None :
+                        steps_iter = None
+                        return
+                    i = n
+                    if s.stdin is not None :
+                        raise PypelineException('Step %s is generated lazily, it cannot '
+                                                'read the output of another step'%s.name)
+                    if s.depends is None :
+                        d = [i-1] if i > 0 else []
+                    else :
+                        d = set()
+                        step_deps = s.depends
+                        if not isinstance(step_deps,(list,tuple,set)) :
+                            step_deps = [step_deps]
+                        for dep in step_deps :
+                            j = find(dep)
+                            if j is None :
+                                raise PypelineException('Step %s depends on unknown step %r'%(s.name,dep))
+                            d.add(j)
+                        d = sorted(d)
+                    generated_ids[id(s)] = i
+                    generated_names.setdefault(s.name,i)
+                    self.steps.append(s)
+                    s.stats = {}
+                    depends.append(d)
+                    producers.append(None)
+                    dependents.append([])
+                    n_waiting.append(0)
+                    for j in d :
+                        if not finished[j] :
+                            dependents[j].append(i)
+                            n_waiting[i] += 1
+                    prio.append((-s.priority,0.))
+                    results.append(None)
+                    finished.append(0)
+                    n += 1
+                    if i in journaled and journaled[i][0] == s.name :
+                        restored[i] = journaled.pop(i)[1]
+                    if n_waiting[i] == 0 :
+                        heapq.heappush(ready,(prio[i],i))
+
+            def release(i) :
+                s = self.steps[i]
+                state = s.stats.get('status')
+                self._released[state] = self._released.get(state,0)+1
+                if generated_ids.get(id(s)) == i :
+                    del generated_ids[id(s)]
+                self.steps[i] = depends[i] = dependents[i] = prio[i] = None
+                if self._on_finish is not None : # only handed to aiter_run()
+                    results[i] = None
+
+            def finish(i,r) :
+                nonlocal n_done, last_done, failed
+                n_done += 1
+                last_done = max(last_done,i)
+                results[i] = r
+                finished[i] = 1
+                if self.journal is not None :
+                    self.journal.end_step(i,self.steps[i],r)
                 if not self.ignore_failure and r is False :
-                    self.error('Step %d failed, aborting pipeline\n'%i)
+                    if running :
+                        self.error('Step %d failed, waiting for %d running '
+                                   'step(s) and aborting pipeline\n'%(i,len(running)))
+                    else :
+                        self.error('Step %d failed, aborting pipeline\n'%i)
+                    failed = True
+                for j in dependents[i] :
+                    n_waiting[j] -= 1
+                    if n_waiting[j] == 0 :
+                        heapq.heappush(ready,(prio[j],j))
+                if self._on_finish is not None :
+                    self._on_finish((i,self.steps[i].name,r))
+                if i >= n_static :
+                    release(i)
+
+            while True :
+                if steps_iter is not None and not failed :
+                    generate()
+                # steps that don't fit in the budget wait, letting smaller
+                # ones after them start in the meantime
+                blocked = []
+                while ready and len(running) < max_workers and not failed :
+                    key, i = heapq.heappop(ready)
+                    group = stream_group(i)
+                    if i in restored :
+                        for j in group :
+                            self.steps[j].stats = {'step':j,'name':self.steps[j].name,'status':'restored'}
+                            finish(j,restored.pop(j))
+                        continue
+                    group_claims = {}
+                    if budget is not None :
+                        group_claims = budget.acquire_group([self.steps[j] for j in group])
+                        if group_claims is None :
+                            blocked.append((key,i))
+                            continue
+                        group_claims = dict(zip(group,group_claims))
+                    if slots is not None :
+                        n_slots = slots.take(len(group))
+                        if not n_slots : # wait for the runner to grant some
+                            for claim in group_claims.values() :
+                                budget.release(claim)
+                            blocked.append((key,i))
+                            break
+                        slotted.update(group[:n_slots])
+                    claims.update(group_claims)
+                    self._connect_streams(group,producers,selected)
+                    for j in group :
+                        s = self.steps[j]
+                        self.curr_step_num = j
+                        self.curr_step_name = s.name
+                        if self.journal is not None :
+                            self.journal.start_step(j,s)
+                        task = asyncio.ensure_future(self._run_step(j,s,selected,force))
+                        running[task] = j
+                for item in blocked :
+                    heapq.heappush(ready,item)
+
+                waits = set(running)
+                if slots is not None and slots.settle(bool(ready) and not failed and
+                                                      len(running) < max_workers) :
+                    waits.add(slots.granted_future())
+                if not waits :
                     break
-        except KeyboardInterrupt :
-            self.printout('\nPipeline interrupted by user, aborting\n')
+
+                done, pending = await asyncio.wait(waits,return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done & set(running),key=running.get) :
+                    i = running.pop(task)
+                    if i in claims :
+                        budget.release(claims.pop(i))
+                    if i in slotted :
+                        slotted.discard(i)
+                        slots.release(1)
+                    if task.exception() is not None :
+                        n_done += 1
+                        last_done = max(last_done,i)
+                        finished[i] = 1
+                        failed = True
+                        exc = exc or task.exception()
+                        if self.journal is not None :
+                            self.journal.end_step(i,self.steps[i],None)
+                        continue
+                    finish(i,task.result())
+
+            if exc is not None :
+                raise exc
+            if not failed and n_done < n :
+                raise PypelineException('Circular dependencies between steps, '
+                                        'could not run: %s'%', '.join(
+                    str(i) for i in range(n) if n_waiting[i] > 0))
+
+            # like a sequential run, only report up to the last step run
+            self.results = results = results[:last_done+1]
         finally :
-            self.tee_t.stop = True
+            for task in running :
+                task.cancel()
+            if running :
+                await asyncio.gather(*running,return_exceptions=True)
+            for s in self.steps :
+                if s is not None :
+                    self._close_streams(s)
+            for claim in claims.values() :
+                budget.release(claim)
+            if slots is not None :
+                slots.release(len(slotted))
+                slots.settle(False)
+            self._shutdown_process_pool()
+            self._run_end = time.time()
+            self._record_history()
+            if self.trace_path is not None :
+                self._write_trace(start)
+            if status_server is not None :
+                await status_server.close()
+            self._write_report(start,max_workers)
+            if self.journal is not None :
+                self.journal.close()
+            del self.steps[n_static:]
+            if not self.tee_t.close(timeout=10) :
+                self.warn('Pipeline output is still held open by a running '
+                          'process, some of it may not be logged\n')
 
         return results
 
 
 def _check_conditions(f) :
-    """Decorator function for PypeStep subclass execute methods. Should
-    not be invoked by the user."""
+    """Decorator function for PypeStep subclass execute methods, and
+    execute_async coroutines. Should not be invoked by the user."""
+    if inspect.iscoroutinefunction(f) :
+        async def anf(self,*args,**kwargs):
+            self.check_precondition()
+            ret = await f(self,*args,**kwargs)
+            self.check_postcondition()
+            return ret
+        return anf
     def nf(self,*args,**kwargs):
         self.check_precondition()
         ret = f(self,*args,**kwargs)
@@ -256,12 +3301,40 @@ class PypeStep :
 the execute() method for custom functionality or use a canned class from this
 package (e.g. ProcessPypeStep)."""
 
-    def __init__(self,name,silent=False,precondition=lambda:True,postcondition=lambda:True,ignore_failure=False) :
+    # pipelines can have 100k+ steps, __dict__ is only allocated for
+    # attributes set on a step that aren't listed here
+    __slots__ = ('name','silent','precondition','postcondition','ignore_failure',
+                 'depends','inputs','outputs','cpus','memory','priority','stdin',
+                 '_stream_in','_stream_out','stats','stdout','stderr','pipeline',
+                 '__dict__')
+
+    def __init__(self,name,silent=False,precondition=lambda:True,postcondition=lambda:True,ignore_failure=False,depends=None,inputs=None,outputs=None,cpus=1,memory=None,priority=0,stdin=None) :
         self.name = name
         self.silent = silent
         self.precondition = precondition
         self.postcondition = postcondition
         self.ignore_failure = ignore_failure
+        # steps (objects, names or indices) that must finish before this one
+        # starts, None means the step immediately before it in the pipeline
+        self.depends = depends
+        # files read and written by the step, a step with declared outputs
+        # is skipped when they are up to date (see FingerprintStore)
+        self.inputs = [inputs] if isinstance(inputs,str) else list(inputs or [])
+        self.outputs = [outputs] if isinstance(outputs,str) else list(outputs or [])
+        # cpus and memory (bytes, or a string like '64G') the step needs,
+        # see Pypeline(resources=...), steps with higher priority start first
+        self.cpus = cpus
+        self.memory = parse_memory(memory)
+        self.priority = priority
+        # step (object, name or index) whose stdout is piped into this
+        # step's stdin, the two run at the same time
+        self.stdin = stdin
+        self._stream_in = self._stream_out = None
+        # wall time and resource usage of the last run, see Pypeline.report
+        self.stats = {}
+        # StepOutput captures of the last run, see Pypeline(capture=True)
+        self.stdout = None
+        self.stderr = None
 
     def check_precondition(self) :
         precond_met = self.precondition() == True
@@ -281,6 +3354,12 @@ package (e.g. ProcessPypeStep)."""
                 self._print_msg('\tPrecondition not met, dying')
                 raise PypelineException('Precondition not met for step %s'%self.name)
 
+    def fingerprint_data(self) :
+        """Return JSON-able data describing what the step does, used to
+        decide whether previously produced outputs are still valid.
+        Override in subclasses."""
+        return {'class':self.__class__.__name__,'name':self.name}
+
     @_check_conditions
     def execute(self) :
         raise PypelineException('PypeStep.execute() method is not defined, override in subclasses of PypeStep')
@@ -288,6 +3367,49 @@ package (e.g. ProcessPypeStep)."""
     def skip(self) :
         pass # do nothing by default
 
+    async def execute_async(self) :
+        """Coroutine called by Pypeline.run_async.  By default runs
+        execute() in a thread, or on the calling thread when the pipeline
+        runs its steps one at a time (see Pypeline.run()), override for
+        asyncio-native steps."""
+        return await self._call_blocking(self.execute)
+
+    async def skip_async(self) :
+        """Coroutine called by Pypeline.run_async for skipped steps, runs
+        skip() like execute_async() runs execute()"""
+        if self.__class__.skip is PypeStep.skip :
+            return self.skip()
+        return await self._call_blocking(self.skip)
+
+    async def _call_blocking(self,f) :
+        if self.pipeline._inline_steps :
+            return self._thread_call(f)
+        return await run_in_thread(self._thread_call,f)
+
+    def _thread_call(self,f) :
+        """Call *f* and add the CPU time used by the calling thread to
+        the step's stats"""
+        thread_ru = getattr(resource,'RUSAGE_THREAD',None)
+        if thread_ru is None :
+            return f()
+        ru_st = resource.getrusage(thread_ru)
+        try :
+            return f()
+        finally :
+            ru_end = resource.getrusage(thread_ru)
+            self.stats['ru_utime'] = self.stats.get('ru_utime',0)+ru_end.ru_utime-ru_st.ru_utime
+            self.stats['ru_stime'] = self.stats.get('ru_stime',0)+ru_end.ru_stime-ru_st.ru_stime
+
+    def _output_writers(self,prefix=None) :
+        """Return writers for the stdout and stderr of a call, forwarding
+        both to the pipeline's Tee and to the step's captures"""
+        tee_w = _FdWriter(self.pipeline.out_f.fileno())
+        writers = []
+        for capture in (self.stdout,self.stderr) :
+            outs = [tee_w] if capture is None else [tee_w,capture]
+            writers.append([_LinePrefixer(outs,prefix)] if prefix else outs)
+        return writers
+
     def _info_msg(self,msg) :
         if not self.silent :
             self.pipeline.info(msg)
@@ -301,6 +3423,9 @@ package (e.g. ProcessPypeStep)."""
 class PythonPypeStep(PypeStep) :
     """A pipeline step that accepts a python callable as its action"""
 
+    __slots__ = ('callable','callable_args','callable_kwargs','skipcallable',
+                 'skipcallable_args','executor','timeout','cache')
+
     def __init__(self,name,callable,
                  callable_args=(),
                  callable_kwargs={},
@@ -309,17 +3434,58 @@ class PythonPypeStep(PypeStep) :
                  silent=False,
                  precondition=lambda:True,
                  postcondition=lambda:True,
-                 ignore_failure=False) :
+                 ignore_failure=False,
+                 depends=None,
+                 inputs=None,
+                 outputs=None,
+                 executor=None,
+                 timeout=None,
+                 cache=False,
+                 cpus=1,
+                 memory=None,
+                 priority=0,
+                 stdin=None) :
         PypeStep.__init__(self,name,
                           silent=silent,
                           precondition=precondition,
                           postcondition=postcondition,
-                          ignore_failure=ignore_failure)
+                          ignore_failure=ignore_failure,
+                          depends=depends,
+                          inputs=inputs,
+                          outputs=outputs,
+                          cpus=cpus,
+                          memory=memory,
+                          priority=priority,
+                          stdin=stdin)
         self.callable = callable
         self.callable_args = callable_args
         self.callable_kwargs = callable_kwargs
         self.skipcallable = skipcallable
         self.skipcallable_args = skipcallable_args
+        # 'process' runs the callable in the pipeline's process pool, so
+        # CPU bound steps don't hold the GIL; the callable, its arguments
+        # and its result must be picklable.  None runs it in a thread.
+        if executor not in (None,'thread','process') :
+            raise PypelineException('Unknown executor for step %s: %r'%(name,executor))
+        self.executor = executor
+        # seconds after which the step fails, a process pool worker running
+        # it is killed, a thread is left to finish in the background
+        self.timeout = timeout
+        # True to reuse the result of an earlier call of the same callable
+        # with equal arguments from the pipeline's result cache, or a
+        # ResultCache to use instead; only for callables whose result
+        # depends on nothing but their arguments
+        self.cache = cache
+
+    def fingerprint_data(self) :
+        d = PypeStep.fingerprint_data(self)
+        # the source is hashed, the byte code alone misses changed constants,
+        # along with the defaults and closure values the callable captured
+        d.update({'callable':_callable_identity(self.callable),
+                  'captured':_captured_values(self.callable),
+                  'args':repr(self.callable_args),
+                  'kwargs':repr(sorted(self.callable_kwargs.items()))})
+        return d
 
     @_check_conditions
     def execute(self) :
@@ -332,12 +3498,124 @@ class PythonPypeStep(PypeStep) :
         #print 'done switching fds'
 
         # who you gonna call?
-        r = self.callable(*self.callable_args,**self.callable_kwargs)
+        r = self._hooked_callable()(*self.callable_args,**self.callable_kwargs)
+        if inspect.isawaitable(r) :
+            r = _run_awaitable(r)
 
         # put back original sys file descriptors
         sys.stdout, sys.stderr = old_stdout, old_stderr
         return r
 
+    def _hooked_callable(self) :
+        """The callable wrapped by the pipeline's hooks, see
+        PypelineHook.wrap_callable()"""
+        fn = self.callable
+        pipeline = getattr(self,'pipeline',None)
+        if pipeline is None :
+            return fn
+        for hook in pipeline.hooks :
+            try :
+                fn = hook.wrap_callable(pipeline,self.stats.get('step'),self,fn)
+            except Exception as e :
+                pipeline.warn('wrap_callable hook %s failed: %s\n'%(hook.__class__.__name__,e))
+        return fn
+
+    def _result_cache(self) :
+        if isinstance(self.cache,ResultCache) :
+            return self.cache
+        if self.cache and self._stream_in is None and self._stream_out is None :
+            return self.pipeline.result_cache
+        return None
+
+    async def execute_async(self) :
+        cache = self._result_cache()
+        if cache is None :
+            return await self._execute_uncached()
+        key = await run_in_thread(cache.key,self.callable,self.callable_args,self.callable_kwargs)
+        hit, r = await run_in_thread(cache.get,key)
+        if hit :
+            self.check_precondition()
+            self.stats['cache'] = 'hit'
+            self._info_msg(self.name+' (cached)')
+            return r
+        self.stats['cache'] = 'miss'
+        r = await self._execute_uncached()
+        if r is not False :
+            await run_in_thread(cache.put,key,r)
+        return r
+
+    async def _execute_uncached(self) :
+        streaming = self._stream_in is not None or self._stream_out is not None
+        try :
+            if streaming :
+                if self.executor == 'process' or inspect.iscoroutinefunction(self.callable) :
+                    raise PypelineException('Step %s is piped to another step, its callable '
+                                            'must run in a thread'%self.name)
+                coro = run_in_thread(self._thread_call,self._execute_stream)
+            elif self.executor == 'process' :
+                return await self._execute_process()
+            elif inspect.iscoroutinefunction(self.callable) :
+                coro = self._execute_coroutine()
+            elif self.timeout is not None : # only a thread can be timed out
+                coro = run_in_thread(self._thread_call,self.execute)
+            else :
+                coro = PypeStep.execute_async(self)
+            return await asyncio.wait_for(coro,self.timeout)
+        except asyncio.TimeoutError :
+            self.stats['timed_out'] = True
+            self._print_msg('\tTimed out after %ss'%self.timeout)
+            return False
+
+    @_check_conditions
+    async def _execute_coroutine(self) :
+        self._info_msg(self.name)
+        return await self.callable(*self.callable_args,**self.callable_kwargs)
+
+    @_check_conditions
+    async def _execute_process(self) :
+        """Run the callable in the pipeline's process pool, its output is
+        forwarded to the pipeline log and the step's captures when it
+        returns"""
+        self._info_msg(self.name)
+        r, exc, out, err, stats = await self.pipeline._call_in_process(
+            self._hooked_callable(),self.callable_args,self.callable_kwargs,timeout=self.timeout)
+        stats['cmd'] = getattr(self.callable,'__name__',repr(self.callable))
+        self.stats.setdefault('calls',[]).append(stats)
+        for data, outs in zip((out,err),self._output_writers()) :
+            for w in outs :
+                if data :
+                    w.write(data)
+                w.eof()
+        if exc is not None :
+            raise exc
+        return r
+
+    @_check_conditions
+    def _execute_stream(self) :
+        """Call the callable with an iterator over the chunks of bytes read
+        from the step's stdin as first argument, if it reads another step's
+        output, and write the chunks the returned generator yields to its
+        stdout, if that is piped"""
+        self._info_msg(self.name)
+        # the pipeline closes its pipes when the step ends, even if it timed
+        # out with this thread still running
+        in_fd = out_fd = None
+        try :
+            args = tuple(self.callable_args)
+            if self._stream_in is not None :
+                in_fd = os.dup(self._stream_in)
+                args = (iter_chunks(in_fd),)+args
+            if self._stream_out is not None :
+                out_fd = os.dup(self._stream_out)
+            r = self._hooked_callable()(*args,**self.callable_kwargs)
+            if out_fd is not None and hasattr(r,'__next__') :
+                r = write_chunks(r,out_fd)
+            return r
+        finally :
+            for fd in (in_fd,out_fd) :
+                if fd is not None :
+                    os.close(fd)
+
     def skip(self) :
         self._info_msg(self.name+' SKIPPED')
         return self.skipcallable(*self.skipcallable_args)
@@ -346,18 +3624,40 @@ class PythonPypeStep(PypeStep) :
 class ProcessPypeStep(PypeStep) :
     """A pipeline step that wrap subprocess.Popen calls for a command line utility"""
 
+    __slots__ = ('calls','skipcalls','env','max_procs','fail_fast','remote','shell_pool','_shells')
+
     def __init__(self,name,calls,
                  skipcalls=None,
                  silent=False,
                  precondition=lambda:True,
                  postcondition=lambda:True,
                  env=None,
-                 ignore_failure=False) :
+                 ignore_failure=False,
+                 depends=None,
+                 inputs=None,
+                 outputs=None,
+                 max_procs=1,
+                 fail_fast=False,
+                 remote=None,
+                 shell_pool=False,
+                 cpus=None,
+                 memory=None,
+                 priority=0,
+                 stdin=None) :
         PypeStep.__init__(self,name,
                           silent=silent,
                           precondition=precondition,
                           postcondition=postcondition,
-                          ignore_failure = ignore_failure)
+                          ignore_failure = ignore_failure,
+                          depends=depends,
+                          inputs=inputs,
+                          outputs=outputs,
+                          cpus=max_procs if cpus is None else cpus,
+                          memory=memory,
+                          priority=priority,
+                          stdin=stdin)
+        # each call is a command string, exec'd directly unless it uses
+        # shell syntax, or an argv list/tuple; a lone tuple is one call
         self.calls = calls if type(calls) is list else [calls]
         skipcalls = skipcalls or []
         try :
@@ -366,31 +3666,394 @@ class ProcessPypeStep(PypeStep) :
             skipcalls = tuple(skipcalls)
         self.skipcalls = skipcalls
         self.env = env or {}
+        # run up to max_procs of the calls at once, output lines of each
+        # call are prefixed with its index in calls
+        self.max_procs = max_procs
+        # with max_procs > 1, terminate running calls when one fails
+        self.fail_fast = fail_fast
+        # run the calls on the pipeline's remote workers, None means
+        # whenever the pipeline has workers
+        self.remote = remote
+        # run the calls in up to max_procs long-lived shells, see ShellPool,
+        # for many short commands whose launch time would dominate
+        self.shell_pool = shell_pool
+        self._shells = None
+
+    def fingerprint_data(self) :
+        d = PypeStep.fingerprint_data(self)
+        d.update({'calls':self.calls,'env':self.env})
+        return d
 
-    @_check_conditions
     def execute(self) :
+        return asyncio.run(self.execute_async())
+
+    @_check_conditions
+    async def execute_async(self) :
         self._info_msg(self.name)
+        async with self._shell_pool(len(self.calls)) :
+            if self.max_procs > 1 and len(self.calls) > 1 :
+                return await self._execute_concurrent()
+            return await self._run_calls(self.calls)
+
+    @contextlib.asynccontextmanager
+    async def _shell_pool(self,n_calls) :
+        """Start the step's ShellPool, if it has one, for *n_calls* calls"""
+        if not self.shell_pool :
+            yield
+            return
+        if self._stream_in is not None or self._stream_out is not None :
+            raise PypelineException('Step %s is piped to another step, it cannot '
+                                    'use a shell pool'%self.name)
+        if self.remote or self.remote is None and self.pipeline.workers is not None :
+            raise PypelineException('Step %s is remote, it cannot use a shell pool'%self.name)
+        self._shells = ShellPool(max(1,min(self.max_procs,n_calls)),self.env)
+        try :
+            yield
+        finally :
+            shells, self._shells = self._shells, None
+            await shells.close()
+
+    async def _spawn_call(self,cmd,st,prefix=None,**popen_kwargs) :
+        """Start *cmd* like _spawn(), adding its process to the pipeline's
+        ProcessSampler while it runs, if it is tracing"""
+        p, wait = await self._spawn(cmd,st,prefix,**popen_kwargs)
+        sampler = self.pipeline._sampler
+        pid = p.pid if isinstance(p,Popen) else p.proc.pid if isinstance(p,ShellCall) else None
+        if sampler is None or pid is None :
+            return p, wait
+        sampler.add(pid,self.stats.get('step'))
+        async def tracked() :
+            try :
+                return await wait
+            finally :
+                sampler.remove(pid)
+        return p, tracked()
+
+    async def _spawn(self,cmd,st,prefix=None,**popen_kwargs) :
+        """Start *cmd* and return its Popen, or RemoteCall, along with a
+        coroutine that waits for it to exit, like wait_rusage_async().
+        Local output goes straight to the pipeline's Tee unless it is
+        captured or needs *prefix*, then it is forwarded through pipes read
+        by the event loop.  Streaming steps read from and write to the
+        pipes connecting them to their neighbours instead."""
+        if self._shells is not None :
+            return await self._shells.spawn(cmd,self._output_writers(prefix))
+        streaming = self._stream_in is not None or self._stream_out is not None
+        workers = self.pipeline.workers
+        if workers is not None and self.remote is None and not streaming or self.remote :
+            if workers is None :
+                raise PypelineException('Step %s is remote but the pipeline has no workers'%self.name)
+            if streaming :
+                raise PypelineException('Step %s is piped to another step, it cannot be remote'%self.name)
+            return await workers.spawn(cmd,self.env,self._output_writers(prefix))
+
+        if prefix is None and self.stdout is None and self.stderr is None :
+            out_fd = self.pipeline.out_f.fileno()
+            stdout = out_fd if self._stream_out is None else self._stream_out
+            p = popen_command(cmd,env=self.env,stdin=self._stream_in,
+                              stdout=stdout,stderr=out_fd,**popen_kwargs)
+            return p, wait_rusage_async(p,cmd,st)
+
+        pipes, fds = [], []
+        for stream_fd, outs in zip((self._stream_out,None),self._output_writers(prefix)) :
+            if stream_fd is None :
+                r_fd, w_fd = os.pipe()
+                pipes.append((r_fd,w_fd,outs))
+                stream_fd = w_fd
+            fds.append(stream_fd)
+        try :
+            p = popen_command(cmd,env=self.env,stdin=self._stream_in,
+                              stdout=fds[0],stderr=fds[1],**popen_kwargs)
+        except BaseException :
+            for r_fd, w_fd, outs in pipes :
+                os.close(r_fd)
+            raise
+        finally :
+            for r_fd, w_fd, outs in pipes :
+                os.close(w_fd)
+
+        async def wait() :
+            # cancelled runs are mostly cancelled here, while the output
+            # is forwarded, and must not leave the command running
+            try :
+                await asyncio.gather(*[_forward_output(r_fd,outs) for r_fd, w_fd, outs in pipes])
+            except asyncio.CancelledError :
+                await terminate_process_async(p,cmd,st)
+                raise
+            return await wait_rusage_async(p,cmd,st)
+        return p, wait()
+
+    async def _run_calls(self,cmds) :
+        """Run *cmds* one after the other, stop at the first failure unless
+        ignoring failures"""
         r = 0
-
-        for cmd in self.calls :
-            self._print_msg('\t'+cmd)
-            # filter out extra whitespace
-            cmd = cmd.strip()
-            cmd = re.sub(r'\s+',r' ',cmd)
-            r = call(cmd,shell=True,env=self.env,
-                     stdout=self.pipeline.tee_t.out_w,
-                     stderr=self.pipeline.out_f)
+        calls = self.stats.setdefault('calls',[])
+        for cmd in cmds :
+            self._print_msg('\t'+command_str(cmd))
+            p, wait = await self._spawn_call(cmd,time.time())
+            r, cmd_stats = await wait
+            calls.append(cmd_stats)
+            if self._stream_out is not None and r in (-signal.SIGPIPE,128+signal.SIGPIPE) :
+                # killed writing to the step it is piped to, which exited
+                # early without reading everything, like head
+                r = 0
             if not self.ignore_failure and r != 0 : # presumed failure
                 break
 
         return self.ignore_failure or r == 0
 
+    async def _execute_concurrent(self) :
+        """Run up to max_procs of the calls at once, prefixing each line of
+        their output with the index of the call.  Without ignore_failure,
+        no more calls are started after one fails, and the running ones are
+        terminated if fail_fast is set."""
+        slots = asyncio.Semaphore(self.max_procs)
+        running = {}
+        failed = []
+        cmd_stats = [None]*len(self.calls)
+
+        async def run_call(k,cmd) :
+            async with slots :
+                if failed :
+                    return
+                self._print_msg('\t[%d] %s'%(k,command_str(cmd)))
+                # own process group, so fail_fast can stop the whole call
+                p, wait = await self._spawn_call(cmd,time.time(),
+                                                 prefix=('[%d] '%k).encode(),
+                                                 start_new_session=self.fail_fast)
+                running[k] = p
+                r, cmd_stats[k] = await wait
+                cmd_stats[k]['index'] = k
+                del running[k]
+                if r != 0 and not self.ignore_failure and not failed :
+                    failed.append(k)
+                    if self.fail_fast :
+                        for p in running.values() :
+                            terminate_process(p)
+
+        await asyncio.gather(*[run_call(k,cmd) for k,cmd in enumerate(self.calls)])
+
+        done = [c for c in cmd_stats if c is not None]
+        self.stats.setdefault('calls',[]).extend(done)
+        return self.ignore_failure or all(c['returncode'] == 0 for c in done)
+
     def skip(self) :
+        return asyncio.run(self.skip_async())
+
+    async def skip_async(self) :
         self._info_msg(self.name+' SKIPPED')
-        r = 0
-        for cmd in self.skipcalls :
-            self._print_msg('\t'+cmd)
-            r = call(cmd,shell=True,env=self.env,stdout=self.out_f,stderr=self.out_f)
-            if not self.ignore_failure and r != 0 : # presumed failure
-                break
-        return self.ignore_failure or r == 0
+        return await self._run_calls(self.skipcalls)
+
+
+class MapPypeStep(ProcessPypeStep) :
+    """A pipeline step that runs a command or callable template once for
+    each of *params*, its shards, up to *max_procs* at a time.
+
+    A command template (string or argv list) is filled in with str.format()
+    for each parameter: a dict fills named fields, a tuple positional
+    fields, anything else {} (braces meant for the shell are doubled, e.g.
+    ${{HOME}}).  A callable template is called with the parameter followed
+    by *callable_args* and *callable_kwargs*, in a thread or, with
+    executor='process', in the pipeline's process pool; a shard fails if it
+    raises an exception or returns False.
+
+    *shards* selects the shards to run (indices, a StepList or a string
+    like '0-99,120'), the others are skipped.  Failed shards are retried up
+    to *retries* times.  After a run, shard_status holds the status and
+    result of each shard and failed_shards() the shards to run again.  When
+    resuming a pipeline, only the shards that did not complete are rerun.
+
+    The result of the step is the list of shard results, exit codes for
+    commands, or False if a shard failed and failures are not ignored."""
+
+    __slots__ = ('template','params','shards','retries','callable_args',
+                 'callable_kwargs','executor','timeout','shard_status',
+                 'restored_shards')
+
+    def __init__(self,name,template,params,
+                 shards=None,
+                 max_procs=1,
+                 retries=0,
+                 fail_fast=False,
+                 callable_args=(),
+                 callable_kwargs={},
+                 executor=None,
+                 timeout=None,
+                 silent=False,
+                 precondition=lambda:True,
+                 postcondition=lambda:True,
+                 env=None,
+                 ignore_failure=False,
+                 depends=None,
+                 inputs=None,
+                 outputs=None,
+                 remote=None,
+                 shell_pool=False,
+                 cpus=None,
+                 memory=None,
+                 priority=0) :
+        ProcessPypeStep.__init__(self,name,[],
+                                 silent=silent,
+                                 precondition=precondition,
+                                 postcondition=postcondition,
+                                 env=env,
+                                 ignore_failure=ignore_failure,
+                                 depends=depends,
+                                 inputs=inputs,
+                                 outputs=outputs,
+                                 max_procs=max_procs,
+                                 fail_fast=fail_fast,
+                                 remote=remote,
+                                 shell_pool=shell_pool and not callable(template),
+                                 cpus=cpus,
+                                 memory=memory,
+                                 priority=priority)
+        self.template = template
+        self.params = list(params)
+        if isinstance(shards,str) :
+            shards = parse_steplist_str(shards)
+        self.shards = shards
+        self.retries = retries
+        self.callable_args = callable_args
+        self.callable_kwargs = callable_kwargs
+        if executor not in (None,'thread','process') :
+            raise PypelineException('Unknown executor for step %s: %r'%(name,executor))
+        self.executor = executor
+        self.timeout = timeout
+        # dict per shard with its status, result, attempts and wall time
+        self.shard_status = []
+        # shard index -> result of shards completed in an interrupted run
+        self.restored_shards = {}
+
+    def fingerprint_data(self) :
+        d = PypeStep.fingerprint_data(self)
+        template = self.template
+        if callable(template) :
+            template = {'callable':_callable_identity(template),
+                        'captured':_captured_values(template),
+                        'args':repr(self.callable_args),
+                        'kwargs':repr(sorted(self.callable_kwargs.items()))}
+        params = json.dumps(self.params,sort_keys=True,default=repr)
+        d.update({'template':template,
+                  'params':hashlib.sha1(params.encode('utf-8')).hexdigest(),
+                  'env':self.env})
+        return d
+
+    def command(self,k) :
+        """Return the command of shard *k*, the template filled in with its
+        parameter"""
+        p = self.params[k]
+        if isinstance(p,dict) :
+            fill = lambda t: t.format(**p)
+        elif isinstance(p,tuple) :
+            fill = lambda t: t.format(*p)
+        else :
+            fill = lambda t: t.format(p)
+        if isinstance(self.template,str) :
+            return fill(self.template)
+        return [fill(a) for a in self.template]
+
+    def failed_shards(self) :
+        """StepList of the shards that failed in the last run"""
+        return StepList(st['shard'] for st in self.shard_status if st['status'] == 'failed')
+
+    @_check_conditions
+    async def execute_async(self) :
+        self._info_msg('%s (%d shards)'%(self.name,len(self.params)))
+        n = len(self.params)
+        selected = StepList(range(n)) if self.shards is None else StepList(self.shards)
+        restored, self.restored_shards = self.restored_shards, {}
+        self.shard_status = [{'shard':k,'status':'pending'} for k in range(n)]
+        results = [None]*n
+        for k in range(n) :
+            if k in restored :
+                self.shard_status[k]['status'] = 'restored'
+                results[k] = restored[k]
+            elif k not in selected :
+                self.shard_status[k]['status'] = 'skipped'
+
+        slots = asyncio.Semaphore(max(1,self.max_procs))
+        running = {}
+        failed = []
+
+        async def run_shard(k) :
+            async with slots :
+                if failed and self.fail_fast :
+                    return
+                st = self.shard_status[k]
+                st.update(status='running',start=time.time())
+                for attempt in range(self.retries+1) :
+                    ok, r = await self._run_shard(k,running)
+                    if ok or failed and self.fail_fast :
+                        break # no retries once another shard stopped the step
+                st.update(status='done' if ok else 'failed',result=r,
+                          attempts=attempt+1,wall=time.time()-st['start'])
+                results[k] = r
+                journal = self.pipeline.journal
+                if journal is not None and 'step' in self.stats :
+                    journal.end_shard(self.stats['step'],self,k,st['status'],r)
+                if not ok and not failed :
+                    failed.append(k)
+                    if self.fail_fast and not self.ignore_failure :
+                        for p in running.values() :
+                            terminate_process(p)
+
+        pending = [k for k in range(n) if self.shard_status[k]['status'] == 'pending']
+        async with self._shell_pool(len(pending)) :
+            await asyncio.gather(*[run_shard(k) for k in pending])
+
+        counts = {}
+        for st in self.shard_status :
+            counts[st['status']] = counts.get(st['status'],0)+1
+        self.stats['shards'] = counts
+        failed_shards = self.failed_shards()
+        if failed_shards :
+            self.stats['failed_shards'] = str(failed_shards)
+            self._print_msg('\t%d of %d shards failed: %s'%(len(failed_shards),n,failed_shards))
+            if not self.ignore_failure :
+                return False
+        return results
+
+    async def _run_shard(self,k,running) :
+        """Run shard *k* once, return (ok, result)"""
+        prefix = '[%d] '%k
+        if not callable(self.template) :
+            cmd = self.command(k)
+            self._print_msg('\t%s%s'%(prefix,command_str(cmd)))
+            p, wait = await self._spawn_call(cmd,time.time(),prefix=prefix.encode(),
+                                             start_new_session=self.fail_fast)
+            running[k] = p
+            try :
+                r, cmd_stats = await wait
+            finally :
+                del running[k]
+            cmd_stats['shard'] = k
+            self.stats.setdefault('calls',[]).append(cmd_stats)
+            return r == 0, r
+
+        args = (self.params[k],)+tuple(self.callable_args)
+        try :
+            if self.executor == 'process' :
+                r, exc, out, err, stats = await self.pipeline._call_in_process(
+                    self.template,args,self.callable_kwargs,timeout=self.timeout)
+                stats.update(cmd=getattr(self.template,'__name__',repr(self.template)),shard=k)
+                self.stats.setdefault('calls',[]).append(stats)
+                for data, outs in zip((out,err),self._output_writers(prefix.encode())) :
+                    for w in outs :
+                        if data :
+                            w.write(data)
+                        w.eof()
+                if exc is not None :
+                    raise exc
+            elif inspect.iscoroutinefunction(self.template) :
+                r = await asyncio.wait_for(self.template(*args,**self.callable_kwargs),self.timeout)
+            else :
+                r = await asyncio.wait_for(run_in_thread(self.template,*args,**self.callable_kwargs),
+                                           self.timeout)
+        except asyncio.TimeoutError :
+            self._print_msg('\t%sTimed out after %ss'%(prefix,self.timeout))
+            return False, None
+        except Exception as e :
+            self._print_msg('\t%s%s: %s'%(prefix,e.__class__.__name__,e))
+            return False, None
+        return r is not False, r
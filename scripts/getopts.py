@@ -1,12 +1,10 @@
 #!/usr/bin/env python
 
+# called at the top of many shell scripts, so only what every call needs is
+# imported here: json and pypeline are imported when actually used
 import sys
-import json
 import os
 from optparse import OptionParser
-from subprocess import Popen
-
-from pypeline import MultiLineHelpFormatter as MF
 
 template = """
 OPT_SPEC='
@@ -50,34 +48,56 @@ example above):
 
 #!/bin/bash
 # OPT_SPEC definition
-$(echo $OPT_SPEC | getopts.py $@)"""
-s_parser = OptionParser(usage=s_usage,description=s_desc,formatter=MF())
-s_parser.add_option('--template',dest='templ',action='store_true',help='print to stdout a template that can be used in bash scripts and exit')
-
-if __name__ == '__main__' :
-    
-
-    opts, args = s_parser.parse_args(sys.argv[1:])
-    if opts.templ :
-        sys.stdout.write(template)
-        sys.exit(0)
-
-    json_str = sys.stdin.read()
-    opt_obj =  json.loads(json_str)
+$(echo $OPT_SPEC | getopts.py $@)
+
+Checked specifications are cached in $GETOPTS_CACHE_DIR (default:
+~/.cache/pypeline/getopts), keyed by a hash of the JSON text.
+
+With --batch=FILE, FILE holds one JSON list of arguments per line, and the
+declarations for each are written out followed by a NUL character, so many
+argument vectors are parsed with a single interpreter start.  Vectors that
+fail to parse produce an empty block, and the exit status is 1."""
+
+
+def make_s_parser(help=False) :
+    """Parser of getopts.py's own arguments, the help formatter is only
+    imported when help is asked for"""
+    kwargs = {}
+    if help :
+        from pypeline import MultiLineHelpFormatter as MF
+        kwargs['formatter'] = MF()
+    s_parser = OptionParser(usage=s_usage,description=s_desc,**kwargs)
+    s_parser.add_option('--template',dest='templ',action='store_true',help='print to stdout a template that can be used in bash scripts and exit')
+    s_parser.add_option('--batch',dest='batch',default=None,help='parse each JSON list of arguments in this file, one per line')
+    s_parser.add_option('--no-cache',dest='cache',action='store_false',default=True,help='do not read or write the specification cache')
+    return s_parser
+
+
+def cache_path(json_str) :
+    import hashlib
+    cache_dir = os.environ.get('GETOPTS_CACHE_DIR') or \
+        os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),'pypeline','getopts')
+    key = hashlib.sha1(json_str.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir,key+'.marshal')
+
+
+def compile_spec(json_str) :
+    """Check the JSON option specification and return it as (usage,
+    description, argument names, [(option strings, add_option kwargs)]),
+    exits with a message if it is invalid"""
+    import json
+    opt_obj = json.loads(json_str)
 
     # set some stuff
     name = opt_obj.get('NAME',None)
     if name is None :
         sys.stderr.write('Must specify NAME field when using getopts.py, exiting\n')
         sys.exit(1)
-    args = opt_obj.get('ARGS')
-    args_str = ' '.join(["<%s>"%s for s in args]) if args is not None else None
-    usage = "%s [options] %s"%(name,args_str)
+    args = opt_obj.get('ARGS') or []
+    usage = "%s [options] %s"%(name,' '.join(["<%s>"%s for s in args]))
     desc = opt_obj.get('DESC','You should write a description!')
 
-    # build the parser
-    parser = OptionParser(usage=usage,description=desc)
-    opt_names = []
+    opts = []
     for k,opt in opt_obj.get('OPTS',{}).items() :
         opt_strs = []
         short, long = opt.get('SHORT'), opt.get('LONG')
@@ -91,20 +111,50 @@ if __name__ == '__main__' :
         if opt.get('ACTION') : d['action'] = opt.get('ACTION')
         if opt.get('DEFAULT') : d['default'] = opt.get('DEFAULT')
         if opt.get('HELP') : d['help'] = opt.get('HELP')
+        opts.append((opt_strs,d))
+    return usage, desc, args, opts
+
+
+def load_spec(json_str,use_cache=True) :
+    """compile_spec() through the cache, marshal is used as it's built in
+    and the fastest to load"""
+    import marshal
+    path = cache_path(json_str) if use_cache else None
+    if path is not None :
+        try :
+            with open(path,'rb') as f :
+                return marshal.load(f)
+        except (IOError,OSError,EOFError,ValueError,TypeError) :
+            pass
+    spec = compile_spec(json_str)
+    if path is not None :
+        try :
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            tmp_path = '%s.%d'%(path,os.getpid())
+            with open(tmp_path,'wb') as f :
+                marshal.dump(spec,f)
+            os.rename(tmp_path,path)
+        except (IOError,OSError,ValueError) : # e.g. a read-only home
+            pass
+    return spec
+
+
+def build_parser(spec) :
+    usage, desc, args, opts = spec
+    parser = OptionParser(usage=usage,description=desc)
+    for opt_strs, d in opts :
         parser.add_option(*opt_strs,**d)
-        opt_names.append(k)
+    return parser
 
-    # parse
-    #if '-h' in sys.argv[1:] or '--help' in sys.argv[1:] :
-    #    parser.print_help(file=sys.stderr)
-    #    sys.exit(1)
-    
-    startargs_i = sys.argv.index('--') if '--' in sys.argv else 1
-    startargs = sys.argv[startargs_i+1:] if startargs_i < len(sys.argv) else []
+
+def declarations(spec,parser,startargs) :
+    """Parse the argument list *startargs* and return the shell declarations
+    of the resulting variables, exits on errors or -h"""
+    usage, desc, args, opts = spec
     if '-h' in startargs or '--help' in startargs :
         parser.print_help(sys.stderr)
         sys.exit(1)
-    opts, pargs = parser.parse_args(startargs)
+    opts_v, pargs = parser.parse_args(startargs)
 
     if len(pargs) != len(args) :
         parser.error('Exactly %d non-option arguments are required'%len(args))
@@ -115,9 +165,64 @@ if __name__ == '__main__' :
         output_str = '\tsetenv %s %s\n'
     else : # assume bash
         output_str = '\texport %s=%s\n'
-        
 
-    output = zip(args,pargs)+[(k,getattr(opts,k)) for k in opt_names]
+    output = list(zip(args,pargs))+[(d['dest'],getattr(opts_v,d['dest'])) for opt_strs, d in opts]
+    out = []
     for name, val in output :
         if ' ' in str(val) : val = '"%s"'%val
-        sys.stdout.write(output_str%(name,val))
+        out.append(output_str%(name,val))
+    return ''.join(out)
+
+
+def run_batch(spec,parser,batch_fn) :
+    """Write the declarations for each JSON list of arguments in file
+    *batch_fn*, each followed by a NUL, and return the number of lists
+    that failed to parse"""
+    import json
+    failed = 0
+    with open(batch_fn) as f :
+        for line_no, line in enumerate(f,1) :
+            if not line.strip() :
+                continue
+            try :
+                startargs = json.loads(line)
+                if not isinstance(startargs,list) :
+                    raise ValueError('not a list of arguments')
+                out = declarations(spec,parser,[str(a) for a in startargs])
+            except SystemExit : # usage errors, or -h
+                out = None
+            except ValueError as e :
+                sys.stderr.write('%s line %d: %s\n'%(batch_fn,line_no,e))
+                out = None
+            if out is None :
+                failed += 1
+                out = ''
+            sys.stdout.write(out+'\0')
+    return failed
+
+
+if __name__ == '__main__' :
+
+    startargs_i = sys.argv.index('--') if '--' in sys.argv else 1
+    startargs = sys.argv[startargs_i+1:] if startargs_i < len(sys.argv) else []
+    own_args = sys.argv[1:startargs_i] if '--' in sys.argv else sys.argv[1:]
+
+    use_cache, batch = True, None
+    if own_args :
+        s_parser = make_s_parser('-h' in own_args or '--help' in own_args)
+        opts, args = s_parser.parse_args(sys.argv[1:])
+        if opts.templ :
+            sys.stdout.write(template)
+            sys.exit(0)
+        use_cache, batch = opts.cache, opts.batch
+
+    json_str = sys.stdin.read()
+    spec = load_spec(json_str,use_cache)
+
+    # build the parser
+    parser = build_parser(spec)
+
+    # parse
+    if batch is not None :
+        sys.exit(1 if run_batch(spec,parser,batch) else 0)
+    sys.stdout.write(declarations(spec,parser,startargs))
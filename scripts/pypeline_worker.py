@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+import asyncio
+import os
+import sys
+
+from optparse import OptionParser
+
+from pypeline import PypelineException, serve_worker
+
+usage = '%prog [options]'
+desc = "Remote worker for pypeline, runs the commands of ProcessPypeSteps " \
+"sent by pipelines created with Pypeline(workers=[...]).  Commands run in the " \
+"working directory of the pipeline, so workers need the same filesystem."
+parser = OptionParser(usage=usage,description=desc)
+parser.add_option('-a','--address',dest='address',default='127.0.0.1:8765',help='host:port, which needs a token, or unix socket path to listen on [default: %default]')
+parser.add_option('-s','--slots',dest='slots',type='int',default=None,help='number of commands to run at once [default: number of cpus]')
+parser.add_option('-t','--token',dest='token',default=os.environ.get('PYPELINE_WORKER_TOKEN'),help='token clients must send, also read from PYPELINE_WORKER_TOKEN')
+
+if __name__ == '__main__' :
+
+    opts, args = parser.parse_args(sys.argv[1:])
+
+    if len(args) != 0 :
+        parser.error('No non-option arguments are accepted')
+
+    try :
+        asyncio.run(serve_worker(opts.address,token=opts.token,slots=opts.slots))
+    except PypelineException as e :
+        parser.error(str(e))
+    except KeyboardInterrupt :
+        pass
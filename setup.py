@@ -3,7 +3,8 @@ from distutils.core import setup
 
 scripts = ['scripts/getopts.py',
            'scripts/steplist.py',
-           'scripts/parse_steplist.py'
+           'scripts/parse_steplist.py',
+           'scripts/pypeline_worker.py'
           ]
 
 setup(name='pypeline',
@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from pypeline import command_argv, _collapse_whitespace
+
+
+class CommandArgvTest(unittest.TestCase) :
+
+    def test_plain_command_split(self) :
+        self.assertEqual(command_argv('sort -k2 -n data.txt'),['sort','-k2','-n','data.txt'])
+        self.assertEqual(command_argv('  echo   a  '),['echo','a'])
+
+    def test_argv_list_kept(self) :
+        self.assertEqual(command_argv(['echo','a | b']),['echo','a | b'])
+        self.assertEqual(command_argv(('ls','-l')),['ls','-l'])
+
+    def test_quoting(self) :
+        self.assertEqual(command_argv('''grep "two words" 'it''s' a\\ b'''),
+                         ['grep','two words','its','a b'])
+        self.assertIsNone(command_argv('echo "unbalanced'))
+
+    def test_line_continuations(self) :
+        self.assertEqual(command_argv('prog \\\n  --flag value'),['prog','--flag','value'])
+        self.assertEqual(command_argv('prog --fl\\\nag'),['prog','--flag'])
+        self.assertEqual(command_argv('prog \\\n "a b"'),['prog','a b'])
+        # kept by the shell within single quotes
+        self.assertIsNone(command_argv("prog \\\n 'a\\\nb'"))
+
+    def test_shell_syntax_left_to_the_shell(self) :
+        for cmd in ('ls | wc -l','a && b','a; b','sort < in','echo a > out',
+                    'echo $HOME','echo `date`','ls *.txt','ls file?','ls [ab]',
+                    'ls ~','(cd /tmp)','echo a # comment','sleep 1 &') :
+            self.assertIsNone(command_argv(cmd),cmd)
+
+    def test_builtins_and_assignments_left_to_the_shell(self) :
+        for cmd in ('cd /tmp','export A=1','source env.sh','. env.sh','ulimit -n 1024',
+                    'A=1 prog','! false','') :
+            self.assertIsNone(command_argv(cmd),cmd)
+        self.assertEqual(command_argv('prog A=1'),['prog','A=1'])
+
+
+class CollapseWhitespaceTest(unittest.TestCase) :
+
+    def test_lines_joined_and_whitespace_squeezed(self) :
+        self.assertEqual(_collapse_whitespace('  ls\n   -l \t /tmp \n'),'ls -l /tmp')
+
+    def test_quotes_and_escapes_kept(self) :
+        self.assertEqual(_collapse_whitespace('echo  "a   b"   \'c\n  d\''),'echo "a   b" \'c\n  d\'')
+        self.assertEqual(_collapse_whitespace('echo "say \\"hi  there\\""   x'),
+                         'echo "say \\"hi  there\\"" x')
+        self.assertEqual(_collapse_whitespace('echo a\\  \\  b'),'echo a\\  \\  b')
+
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,37 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from pypeline import Pypeline, PypelineRunner, ProcessPypeStep
+
+
+def piped_pipeline(name) :
+    """A step followed by a chain of three steps connected by pipes, which
+    need three slots at once"""
+    pipeline = Pypeline(name,fingerprints=None,history=None,result_cache=None)
+    pipeline.add_step(ProcessPypeStep('sleep','sleep 0.1',silent=True))
+    pipeline.add_step(ProcessPypeStep('produce','printf "a\\nb\\n"',silent=True))
+    pipeline.add_step(ProcessPypeStep('copy','cat',stdin='produce',silent=True))
+    pipeline.add_step(ProcessPypeStep('count','wc -l',stdin='copy',silent=True))
+    return pipeline
+
+
+class RunnerTest(unittest.TestCase) :
+
+    def test_piped_groups_wider_than_free_slots(self) :
+        # each run waits for all the slots for its chain, handing them out
+        # to several runs in part used to leave every run waiting
+        runner = PypelineRunner(max_workers=3)
+        pipelines = [piped_pipeline('p%d'%i) for i in range(3)]
+        async def run_all() :
+            return await asyncio.wait_for(asyncio.gather(
+                *[runner.run_async(p) for p in pipelines]),30)
+        results = asyncio.run(run_all())
+        self.assertEqual(results,[[True]*4]*3)
+        self.assertEqual(runner.free,3)
+
+
+if __name__ == '__main__' :
+    unittest.main()
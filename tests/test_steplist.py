@@ -0,0 +1,89 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from pypeline import StepList, parse_steplist_str
+
+
+class StepListTest(unittest.TestCase) :
+
+    def test_indices_merged_into_intervals(self) :
+        steps = StepList([5,1,2,3,9,10,2])
+        self.assertEqual(steps.ranges(),[(1,4),(5,6),(9,11)])
+        self.assertEqual(list(steps),[1,2,3,5,9,10])
+        self.assertEqual(len(steps),6)
+        self.assertEqual(str(steps),'1-3,5,9-10')
+
+    def test_large_range_kept_as_one_interval(self) :
+        steps = StepList(range(100000))
+        self.assertEqual(steps.ranges(),[(0,100000)])
+        self.assertIn(99999,steps)
+        self.assertNotIn(100000,steps)
+        self.assertNotIn(-1,steps)
+
+    def test_from_ranges_merges_overlapping_and_touching(self) :
+        steps = StepList.from_ranges([(10,12),(0,3),(2,5),(5,7),(8,8)])
+        self.assertEqual(steps.ranges(),[(0,7),(10,12)])
+
+    def test_add_range(self) :
+        steps = StepList.from_ranges([(0,2),(4,6),(8,10)])
+        steps.add_range(12,14)
+        self.assertEqual(steps.ranges(),[(0,2),(4,6),(8,10),(12,14)])
+        steps.add_range(1,9)
+        self.assertEqual(steps.ranges(),[(0,10),(12,14)])
+        steps.add_range(10,12)
+        self.assertEqual(steps.ranges(),[(0,14)])
+        steps.add_range(3,3)
+        self.assertEqual(steps.ranges(),[(0,14)])
+        steps.add(-1)
+        self.assertEqual(steps.ranges(),[(-1,14)])
+
+    def test_union(self) :
+        steps = StepList([0,1,5])|[2,6,7]
+        self.assertIsInstance(steps,StepList)
+        self.assertEqual(steps.ranges(),[(0,3),(5,8)])
+
+    def test_intersection(self) :
+        a = StepList.from_ranges([(0,5),(10,20)])
+        b = StepList.from_ranges([(3,12),(15,16),(19,30)])
+        self.assertEqual((a&b).ranges(),[(3,5),(10,12),(15,16),(19,20)])
+        self.assertEqual((a&b).ranges(),(b&a).ranges())
+        self.assertEqual(list(a&[]),[])
+
+    def test_difference(self) :
+        a = StepList.from_ranges([(0,10),(20,30)])
+        b = StepList.from_ranges([(2,4),(6,22),(25,26)])
+        self.assertEqual((a-b).ranges(),[(0,2),(4,6),(22,25),(26,30)])
+        self.assertEqual((b-a).ranges(),[(10,20)])
+        self.assertEqual(list(a-a),[])
+        self.assertEqual((a-[]).ranges(),a.ranges())
+
+    def test_indexing(self) :
+        steps = StepList([1,2,3,7,8])
+        self.assertEqual(steps[0],1)
+        self.assertEqual(steps[3],7)
+        self.assertEqual(steps[-1],8)
+        self.assertEqual(steps[-5],1)
+        self.assertEqual(steps[1:4],[2,3,7])
+        self.assertRaises(IndexError,steps.__getitem__,5)
+        self.assertRaises(IndexError,steps.__getitem__,-6)
+
+    def test_equality(self) :
+        self.assertEqual(StepList([3,1,2]),[1,2,3])
+        self.assertEqual(StepList([1,2,3]),StepList(range(1,4)))
+        self.assertNotEqual(StepList([1,2]),[2,1])
+        self.assertNotEqual(StepList([1,2]),StepList([1,3]))
+        self.assertFalse(StepList())
+        self.assertTrue(StepList([0]))
+
+    def test_parse_steplist_str(self) :
+        self.assertEqual(parse_steplist_str('0-3,5,7-8').ranges(),[(0,4),(5,6),(7,9)])
+        self.assertEqual(parse_steplist_str('4,2-3').ranges(),[(2,5)])
+        self.assertEqual(list(parse_steplist_str('')),[])
+        self.assertEqual(list(parse_steplist_str(None)),[])
+        self.assertRaises(Exception,parse_steplist_str,'1-x')
+
+
+if __name__ == '__main__' :
+    unittest.main()